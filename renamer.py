@@ -1,10 +1,15 @@
-import os, sys, time, re, json
+import os, sys, time, re, json, bisect, calendar, threading, multiprocessing, stat, math
+import argparse, hashlib, shutil, tempfile, select, signal, ctypes, ctypes.util, struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
 from send2trash import send2trash
 from PIL import Image
-from PyQt5.QtWidgets import QApplication, QCheckBox, QFileDialog, QHBoxLayout, QLabel, QLineEdit, QPushButton, QStyle, QVBoxLayout, QWidget, QSplitter, QFrame, QSizePolicy, QScrollArea, QMenu, QMessageBox, QDialog, QRadioButton
-from PyQt5.QtGui import QPixmap, QPalette, QIcon, QTransform
+from PyQt5.QtWidgets import QApplication, QCheckBox, QComboBox, QFileDialog, QHBoxLayout, QLabel, QLineEdit, QPushButton, QStyle, QVBoxLayout, QWidget, QSplitter, QFrame, QSizePolicy, QScrollArea, QMenu, QMessageBox, QDialog, QRadioButton, QShortcut, QListWidget, QListWidgetItem
+from PyQt5.QtGui import QPixmap, QPalette, QIcon, QTransform, QImage, QImageReader, QKeySequence
 from PyQt5.QtCore import QDir, pyqtSignal, QSize, QTimer, QEvent, QObject
 from PyQt5.QtCore import Qt
+from PyQt5 import sip
 
 stylesheet = """
 	QWidget {
@@ -44,9 +49,1072 @@ stylesheet = """
 	}
 """
 
+class MemoryBudget(object):
+	#lower priorities are evicted first, current images are never evicted
+	PRIORITY_THUMBNAIL = 0
+	PRIORITY_PREFETCH = 1
+	PRIORITY_SCALED = 2
+	PRIORITY_CURRENT = 3
+
+	@property
+	def usage(self):
+		return self._usage
+
+	@property
+	def stats(self):
+		return {"budget":self.maxBytes,
+				"usage":self._usage,
+				"peak":self.peak,
+				"entries":len(self.entries),
+				"hits":self.hits,
+				"misses":self.misses,
+				"evictions":self.evictions,
+				"evictedBytes":self.evictedBytes}
+
+	def __init__(self, megabytes):
+		self.maxBytes = int(megabytes*1024*1024)
+		self.entries = {}
+		self._usage = 0
+		self.peak = 0
+		self.tick = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.evictedBytes = 0
+
+	def put(self, key, obj, size, priority):
+		self.remove(key)
+		self.tick += 1
+		self.entries[key] = [obj, size, priority, self.tick]
+		self._usage += size
+		self.peak = max(self.peak, self._usage)
+		self.evict()
+
+	def __contains__(self, key):
+		return key in self.entries
+
+	def get(self, key):
+		entry = self.entries.get(key)
+		if entry is None:
+			self.misses += 1
+			return None
+		self.hits += 1
+		self.tick += 1
+		entry[3] = self.tick
+		return entry[0]
+
+	def setPriority(self, key, priority):
+		entry = self.entries.get(key)
+		if entry is not None:
+			entry[2] = priority
+			self.evict()
+
+	def remove(self, key):
+		entry = self.entries.pop(key, None)
+		if entry is not None:
+			self._usage -= entry[1]
+
+	def discard(self, file):
+		#keys are tuples of (kind, file, ...)
+		for key in [k for k in self.entries if k[1] == file]:
+			self.remove(key)
+
+	def rekey(self, oldfile, newfile):
+		for key in [k for k in self.entries if k[1] == oldfile]:
+			newkey = (key[0], newfile) + key[2:]
+			self.entries[newkey] = self.entries.pop(key)
+
+	def evict(self):
+		if self._usage <= self.maxBytes:
+			return
+		#evict by priority first, then the biggest, then the least recently used
+		candidates = [(e[2], -e[1], e[3], k) for k, e in self.entries.items() if e[2] < self.PRIORITY_CURRENT]
+		candidates.sort(key=lambda x:x[:3])
+		for priority, negsize, tick, key in candidates:
+			if self._usage <= self.maxBytes:
+				break
+			self.remove(key)
+			self.evictions += 1
+			self.evictedBytes += -negsize
+
+def pixmap_bytes(pixmap):
+	return pixmap.width() * pixmap.height() * max(pixmap.depth(), 8) // 8
+
+memoryBudget = MemoryBudget(float(os.environ.get("PHOTORENAMER_MEMORY_MB", 1024)))
+
+def natural_key(name):
+	#"IMG_9" before "IMG_10", digits and text always alternate so the lists stay comparable
+	return [int(t) if t.isdigit() else t.lower() for t in re.split(r"(\d+)", name)]
+
+def read_exif(file):
+	info = {"date":None, "camera":None, "gps":None}
+	try:
+		with Image.open(file) as im:
+			exif = im.getexif()
+			camera = exif.get(272)
+			if camera:
+				info["camera"] = str(camera).strip("\x00 ")
+			date = exif.get_ifd(0x8769).get(36867) or exif.get(306)
+			if date:
+				date = time.strptime(str(date).strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+				info["date"] = calendar.timegm(date)
+			info["gps"] = gps_coordinates(exif.get_ifd(0x8825))
+	except Exception:
+		pass
+	return info
+
+def gps_coordinates(gps):
+	#degrees, minutes, seconds and a N/S or E/W reference
+	try:
+		lat = sum(float(x)/60**i for i, x in enumerate(gps[2]))
+		lon = sum(float(x)/60**i for i, x in enumerate(gps[4]))
+	except (KeyError, TypeError, ValueError, ZeroDivisionError):
+		return None
+	if str(gps.get(1, "N")).upper().startswith("S"):
+		lat = -lat
+	if str(gps.get(3, "E")).upper().startswith("W"):
+		lon = -lon
+	if math.isnan(lat) or math.isnan(lon):
+		return None
+	return (lat, lon)
+
+def distance_km(lat1, lon1, lat2, lon2):
+	p1 = math.radians(lat1)
+	p2 = math.radians(lat2)
+	a = math.sin((p2-p1)/2)**2 + math.cos(p1)*math.cos(p2)*math.sin(math.radians(lon2-lon1)/2)**2
+	return 2 * 6371.0 * math.asin(min(1.0, math.sqrt(a)))
+
+class PlaceIndex(object):
+	#places are bucketed in a grid of cellSize degrees, a lookup only visits
+	#the cells that can hold a place within the largest radius
+	defaultRadius = 10.0
+
+	def __init__(self, cellSize=0.5):
+		self.cellSize = cellSize
+		self.cells = {}
+		self.names = set()
+		self.maxRadius = 0.0
+
+	def __len__(self):
+		return sum(len(x) for x in self.cells.values())
+
+	def cell(self, lat, lon):
+		return (int(math.floor(lat/self.cellSize)), int(math.floor(lon/self.cellSize)) % int(round(360/self.cellSize)))
+
+	def add(self, name, lat, lon, radius=None):
+		if radius is None:
+			radius = self.defaultRadius
+		self.cells.setdefault(self.cell(lat, lon), []).append((lat, lon, radius, name))
+		self.names.add(name.lower())
+		self.maxRadius = max(self.maxRadius, radius)
+
+	def resolve(self, lat, lon):
+		#lowercase names of all places whose radius covers the point
+		found = set()
+		if not self.cells:
+			return found
+		dlat = self.maxRadius / 111.0
+		coslat = max(math.cos(math.radians(lat)), 0.01)
+		dlon = min(180.0, dlat / coslat)
+		lonCells = int(round(360/self.cellSize))
+		i0, j0 = self.cell(lat - dlat, lon - dlon)
+		i1, j1 = self.cell(lat + dlat, lon + dlon)
+		if j1 < j0:
+			j1 += lonCells
+		for i in range(i0, i1+1):
+			for j in range(j0, min(j1, j0+lonCells-1)+1):
+				for plat, plon, radius, name in self.cells.get((i, j % lonCells), ()):
+					if distance_km(lat, lon, plat, plon) <= radius:
+						found.add(name.lower())
+		return found
+
+	def resolveMany(self, coordinates):
+		return [self.resolve(lat, lon) if lat is not None else set() for lat, lon in coordinates]
+
+	def load(self, path):
+		#geonames dumps (tab separated) or "name,lat,lon[,radius_km]" lines
+		with open(path, "r", encoding="utf-8") as f:
+			for line in f:
+				line = line.rstrip("\n")
+				if not line or line.startswith("#"):
+					continue
+				try:
+					fields = line.split("\t")
+					if len(fields) >= 6:
+						lat, lon = float(fields[4]), float(fields[5])
+						self.add(fields[1], lat, lon)
+						if fields[2] and fields[2] != fields[1]:
+							self.add(fields[2], lat, lon)
+					else:
+						fields = [x.strip() for x in line.split(",")]
+						radius = float(fields[3]) if len(fields) > 3 and fields[3] else None
+						self.add(fields[0], float(fields[1]), float(fields[2]), radius)
+				except (IndexError, ValueError):
+					continue
+
+def gazetteer_path():
+	home = os.path.expanduser("~")
+	return os.environ.get("PHOTORENAMER_GAZETTEER", os.path.join(home, ".photorenamergazetteer"))
+
+class MetadataCache(object):
+	#folder listings come from os.scandir, a fresh listing answers existence checks
+	#and its DirEntry objects answer stat calls, so most lookups cost no syscall
+	@property
+	def stats(self):
+		return {"syscalls":self.syscalls, "saved":self.saved}
+
+	def __init__(self, ttl=5.0):
+		self.ttl = ttl
+		self.folders = {}
+		self.statCache = {}
+		self.exifCache = {}
+		#new path -> former paths of files whose rename is still queued
+		self.moving = {}
+		self.syscalls = 0
+		self.saved = 0
+
+	def key(self, path):
+		return os.path.normpath(path)
+
+	def isFresh(self, t):
+		return time.monotonic() - t < self.ttl
+
+	def scan(self, folder):
+		#name -> DirEntry, or True for files we know exist without an entry
+		folder = self.key(folder)
+		cached = self.folders.get(folder)
+		if cached and self.isFresh(cached[0]):
+			self.saved += 1
+			return cached[1]
+
+		self.syscalls += 1
+		entries = {}
+		with os.scandir(folder) as it:
+			for entry in it:
+				entries[entry.name] = entry
+		self.folders[folder] = [time.monotonic(), entries]
+		return entries
+
+	def listdir(self, folder):
+		return list(self.scan(folder))
+
+	def lookup(self, path):
+		folder, name = os.path.split(self.key(path))
+		cached = self.folders.get(folder)
+		if cached and self.isFresh(cached[0]):
+			return True, cached[1].get(name)
+		return False, None
+
+	def stat(self, path):
+		path = self.key(path)
+		cached = self.statCache.get(path)
+		if cached and self.isFresh(cached[0]):
+			self.saved += 1
+			return cached[1]
+
+		if path in self.moving:
+			#the file is under one of its former names until the rename runs, it is never missing
+			self.syscalls += 1
+			for current in [path] + self.moving[path]:
+				try:
+					st = os.stat(current)
+				except OSError:
+					continue
+				self.statCache[path] = [time.monotonic(), st]
+				return st
+			return None
+
+		known, entry = self.lookup(path)
+		if known and entry is None:
+			self.saved += 1
+			return None
+
+		try:
+			if known and entry is not True:
+				#free on windows, one lstat elsewhere that the entry then keeps
+				if os.name != "nt":
+					self.syscalls += 1
+				st = entry.stat()
+			else:
+				self.syscalls += 1
+				st = os.stat(path)
+		except OSError:
+			st = None
+		self.statCache[path] = [time.monotonic(), st]
+		return st
+
+	def isfile(self, path):
+		known, entry = self.lookup(path)
+		if known:
+			self.saved += 1
+			if entry is None:
+				return False
+			if entry is True:
+				return True
+			return entry.is_file()
+		st = self.stat(path)
+		return st is not None and stat.S_ISREG(st.st_mode)
+
+	def getmtime(self, path):
+		st = self.stat(path)
+		if st is None:
+			raise FileNotFoundError("No such file: '%s'" % path)
+		return st.st_mtime
+
+	def getsize(self, path):
+		st = self.stat(path)
+		if st is None:
+			raise FileNotFoundError("No such file: '%s'" % path)
+		return st.st_size
+
+	def exif(self, path):
+		path = self.key(path)
+		info = self.exifCache.get(path)
+		if info is None:
+			current = path
+			for former in self.moving.get(path, []):
+				if not os.path.exists(current):
+					current = former
+			info = read_exif(current)
+			self.exifCache[path] = info
+		else:
+			self.saved += 1
+		return info
+
+	def renamed(self, oldpath, newpath):
+		oldpath = self.key(oldpath)
+		newpath = self.key(newpath)
+		#whatever was cached for the new path, a missing file included, is stale now
+		for cache in (self.statCache, self.exifCache):
+			cache.pop(newpath, None)
+			if oldpath in cache:
+				cache[newpath] = cache.pop(oldpath)
+		self.moving[newpath] = [oldpath] + self.moving.pop(oldpath, [])
+		self.removeEntry(oldpath)
+		self.addEntry(newpath)
+
+	def settled(self, path):
+		#the queued rename to path has run
+		self.moving.pop(self.key(path), None)
+
+	def changed(self, path):
+		path = self.key(path)
+		self.statCache.pop(path, None)
+		self.exifCache.pop(path, None)
+		#the entry keeps its old stat, forget it
+		self.addEntry(path)
+
+	def removed(self, path):
+		path = self.key(path)
+		self.statCache.pop(path, None)
+		self.exifCache.pop(path, None)
+		self.removeEntry(path)
+
+	def addEntry(self, path):
+		folder, name = os.path.split(path)
+		if folder in self.folders:
+			self.folders[folder][1][name] = True
+
+	def removeEntry(self, path):
+		folder, name = os.path.split(path)
+		if folder in self.folders:
+			self.folders[folder][1].pop(name, None)
+
+	def invalidate(self, folder=None):
+		if folder is None:
+			self.folders = {}
+			self.statCache = {}
+			self.exifCache = {}
+			self.moving = {}
+		else:
+			folder = self.key(folder)
+			self.folders.pop(folder, None)
+			for cache in (self.statCache, self.exifCache):
+				for path in [p for p in cache if os.path.dirname(p) == folder]:
+					del cache[path]
+
+metadataCache = MetadataCache()
+
+PHOTO_FORMATS = ["JPG", "JPEG", "PNG", "GIF", "WEBP", "TIFF", "PSD",
+				"RAW", "BMP", "HEIF", "INDD", "JPEG 2000", "SVG",
+				"AI", "EPS", "PDF", "EXR", "TGA"]
+RAW_FORMATS = ["CR2", "CR3", "CRW", "NEF", "NRW", "ARW", "SRF", "SR2", "DNG", "RAF", "ORF",
+				"RW2", "PEF", "SRW", "X3F", "3FR", "IIQ", "ERF", "MRW", "KDC", "RWL"]
+SIDECAR_FORMATS = ["XMP", "AAE", "THM", "PP3", "DOP"]
+
+class ShotIndex(object):
+	#a shot is the photo shown in the viewer plus the raw twins and sidecars sharing its stem
+	def __init__(self, formats):
+		self.formats = formats
+		self.companions = {}
+		self.stems = {}
+
+	def kind(self, name):
+		ext = os.path.splitext(name)[1].upper()[1::]
+		if ext in self.formats:
+			return "photo"
+		if ext in RAW_FORMATS:
+			return "raw"
+		if ext in SIDECAR_FORMATS:
+			return "sidecar"
+		return None
+
+	def shotStem(self, name):
+		stem, ext = os.path.splitext(name)
+		#sidecars are named either IMG_1.xmp or IMG_1.JPG.xmp
+		if ext.upper()[1::] in SIDECAR_FORMATS:
+			if self.kind(stem) in ("photo", "raw"):
+				return os.path.splitext(stem)[0]
+		return stem
+
+	def preference(self, name):
+		ext = os.path.splitext(name)[1].upper()[1::]
+		if ext in self.formats:
+			return (0, self.formats.index(ext), name)
+		return (1, 0, name)
+
+	def build(self, names):
+		#a single pass over the listing, returns the names to show
+		stems = {}
+		for name in names:
+			if self.kind(name):
+				stems.setdefault(self.shotStem(name), []).append(name)
+
+		self.companions = {}
+		self.stems = {}
+		for stem, group in stems.items():
+			photos = [n for n in group if self.kind(n) != "sidecar"]
+			if photos:
+				primary = min(photos, key=self.preference)
+				self.companions[primary] = sorted(n for n in group if n != primary)
+				self.stems[stem] = primary
+		return list(self.companions)
+
+	def owner(self, stem):
+		return self.stems.get(stem)
+
+	def files(self, primary):
+		return [primary] + self.companions.get(primary, [])
+
+	def targets(self, primary, newstem):
+		#the names every file of the shot gets when the shot is renamed to newstem
+		oldstem = os.path.splitext(primary)[0]
+		return [(n, newstem + n[len(oldstem)::]) for n in self.files(primary)]
+
+	def renamed(self, oldname, newname):
+		newstem = os.path.splitext(newname)[0]
+		self.companions[newname] = [t for n, t in self.targets(oldname, newstem)[1::]]
+		self.companions.pop(oldname, None)
+		self.removeStem(oldname)
+		self.stems[newstem] = newname
+
+	def removed(self, primary):
+		self.companions.pop(primary, None)
+		self.removeStem(primary)
+
+	def removeStem(self, primary):
+		stem = os.path.splitext(primary)[0]
+		if self.stems.get(stem) == primary:
+			del self.stems[stem]
+
+def split_tokens(text):
+	return [t for t in re.split(r"[_\-\s.]+", text.lower()) if t]
+
+def name_tokens(name):
+	#renamed files are "_".join(tags), so the tokens of a name are its tags
+	return set(split_tokens(os.path.splitext(name)[0]))
+
+class TokenIndex(object):
+	def __init__(self):
+		self.postings = {}
+		self.tokens = {}
+
+	def build(self, names):
+		self.postings = {}
+		self.tokens = {}
+		for name in names:
+			self.add(name)
+
+	def add(self, name):
+		tokens = name_tokens(name)
+		self.tokens[name] = tokens
+		for t in tokens:
+			self.postings.setdefault(t, set()).add(name)
+
+	def remove(self, name):
+		for t in self.tokens.pop(name, ()):
+			names = self.postings[t]
+			names.discard(name)
+			if not names:
+				del self.postings[t]
+
+	def renamed(self, oldname, newname):
+		self.remove(oldname)
+		self.add(newname)
+
+	def names(self):
+		return set(self.tokens)
+
+	def lookup(self, word):
+		#"vic*" matches every token starting with vic
+		if word.endswith("*"):
+			prefix = word[:-1]
+			found = set()
+			for t, names in self.postings.items():
+				if t.startswith(prefix):
+					found |= names
+			return found
+		return set(self.postings.get(word, ()))
+
+def date_pattern(template):
+	#the names a DateTab template produces, "YYYY_MM" -> \d\d\d\d_\d\d
+	return re.compile("^" + "".join("\\d" if c in "YMD" else re.escape(c) for c in template) + "(?![0-9])", re.IGNORECASE)
+
+class TagQuery(object):
+	#boolean query over filename tokens, "paris and (victor or justine) and not curu"
+	#a space between words means and, untagged is true for names without any known tag
+	def __init__(self, text, tags=(), dates=()):
+		self.tags = [set(split_tokens(t)) for t in tags if split_tokens(t)]
+		self.dates = [date_pattern(d) for d in dates if d]
+		self.words = re.findall(r"\(|\)|[^\s()]+", text.lower())
+		self.pos = 0
+		self.tree = self.parseOr() if self.words else ("all",)
+		if self.pos != len(self.words):
+			raise ValueError("unexpected '%s'" % self.words[self.pos])
+
+	def and_(self, other):
+		self.tree = ("and", self.tree, other)
+		return self
+
+	def peek(self):
+		return self.words[self.pos] if self.pos < len(self.words) else None
+
+	def parseOr(self):
+		node = self.parseAnd()
+		while self.peek() == "or":
+			self.pos += 1
+			node = ("or", node, self.parseAnd())
+		return node
+
+	def parseAnd(self):
+		node = self.parseNot()
+		while self.peek() not in (None, "or", ")"):
+			if self.peek() == "and":
+				self.pos += 1
+			node = ("and", node, self.parseNot())
+		return node
+
+	def parseNot(self):
+		word = self.peek()
+		if word is None:
+			raise ValueError("incomplete query")
+		self.pos += 1
+		if word == "not":
+			return ("not", self.parseNot())
+		if word == "(":
+			node = self.parseOr()
+			if self.peek() != ")":
+				raise ValueError("missing ')'")
+			self.pos += 1
+			return node
+		if word in ("and", "or", ")"):
+			raise ValueError("unexpected '%s'" % word)
+		if word == "untagged":
+			return ("untagged",)
+		#a tag like saint-malo or a date like 2015_03 is several tokens in the index
+		parts = split_tokens(word)
+		if not parts:
+			raise ValueError("'%s' has no tag in it" % word)
+		node = ("word", parts[0])
+		for part in parts[1::]:
+			node = ("and", node, ("word", part))
+		return node
+
+	def evaluate(self, index, node=None):
+		#set operations on the postings, used for a whole folder at once
+		node = node or self.tree
+		kind = node[0]
+		if kind == "word":
+			return index.lookup(node[1])
+		if kind == "and":
+			return self.evaluate(index, node[1]) & self.evaluate(index, node[2])
+		if kind == "or":
+			return self.evaluate(index, node[1]) | self.evaluate(index, node[2])
+		if kind == "not":
+			return index.names() - self.evaluate(index, node[1])
+		if kind == "untagged":
+			tagged = set()
+			for tokens in self.tags:
+				found = None
+				for t in tokens:
+					found = index.lookup(t) if found is None else found & index.lookup(t)
+				tagged |= found
+			names = index.names() - tagged
+			if self.dates:
+				names = set(n for n in names if not self.isDated(n))
+			return names
+		return index.names()
+
+	def matches(self, name, tokens, node=None):
+		#the same query for a single name, used when one file changes
+		node = node or self.tree
+		kind = node[0]
+		if kind == "word":
+			word = node[1]
+			if word.endswith("*"):
+				return any(t.startswith(word[:-1]) for t in tokens)
+			return word in tokens
+		if kind == "and":
+			return self.matches(name, tokens, node[1]) and self.matches(name, tokens, node[2])
+		if kind == "or":
+			return self.matches(name, tokens, node[1]) or self.matches(name, tokens, node[2])
+		if kind == "not":
+			return not self.matches(name, tokens, node[1])
+		if kind == "untagged":
+			return not any(t <= tokens for t in self.tags) and not self.isDated(name)
+		return True
+
+	def isDated(self, name):
+		return any(d.match(name) for d in self.dates)
+
+class ImageOrder(object):
+	modes = [("name", "name"), 
+			("date", "capture date"), 
+			("mtime", "modification date"), 
+			("size", "size"), 
+			("camera", "camera")]
+
+	def __init__(self, folder, mode="name"):
+		self.folder = folder
+		self.mode = mode
+		self.names = []
+		self.keys = []
+		#bumped on every change, views built on the order use it to know they are stale
+		self.version = 0
+		#sort keys are computed once per file
+		self.keyCache = {}
+
+	def __len__(self):
+		return len(self.names)
+
+	def __getitem__(self, i):
+		return self.names[i]
+
+	def exif(self, name):
+		return metadataCache.exif(os.path.join(self.folder, name))
+
+	def computeKey(self, name):
+		#the name always ends the key so that two files never compare equal
+		natural = natural_key(name)
+		if self.mode == "name":
+			return (natural, name)
+
+		value = None
+		file = os.path.join(self.folder, name)
+		try:
+			if self.mode == "mtime":
+				value = metadataCache.getmtime(file)
+			elif self.mode == "size":
+				value = metadataCache.getsize(file)
+			elif self.mode == "date":
+				value = self.exif(name)["date"]
+				if value is None:
+					value = metadataCache.getmtime(file)
+			elif self.mode == "camera":
+				camera = self.exif(name)["camera"]
+				if camera:
+					value = (camera.lower(), self.exif(name)["date"] or 0)
+		except OSError:
+			pass
+
+		#files without a value go last
+		if value is None:
+			return (True, 0, natural, name)
+		return (False, value, natural, name)
+
+	def sortKey(self, name):
+		key = self.keyCache.get((self.mode, name))
+		if key is None:
+			key = self.computeKey(name)
+			self.keyCache[(self.mode, name)] = key
+		return key
+
+	def reset(self, folder, names):
+		if folder != self.folder:
+			self.keyCache = {}
+		self.folder = folder
+		pairs = sorted((self.sortKey(n), n) for n in names)
+		self.keys = [k for k, n in pairs]
+		self.names = [n for k, n in pairs]
+		self.version += 1
+
+	def setMode(self, mode):
+		if mode != self.mode:
+			self.mode = mode
+			self.reset(self.folder, self.names)
+
+	def index(self, name):
+		key = self.sortKey(name)
+		i = bisect.bisect_left(self.keys, key)
+		if i < len(self.names) and self.names[i] == name:
+			return i
+		raise ValueError("%s is not in the list" % name)
+
+	def add(self, name):
+		key = self.sortKey(name)
+		i = bisect.bisect_left(self.keys, key)
+		self.keys.insert(i, key)
+		self.names.insert(i, name)
+		self.version += 1
+		return i
+
+	def remove(self, name):
+		i = self.index(name)
+		del self.keys[i]
+		del self.names[i]
+		self.forget(name)
+		self.version += 1
+		return i
+
+	def replace(self, oldname, newname):
+		#a rename changes neither size, dates nor exif, only the name part of the keys,
+		#and the renamed file may not even be on disk yet
+		keys = [(mode, self.keyCache.get((mode, oldname))) for mode, label in self.modes]
+		self.remove(oldname)
+		for mode, key in keys:
+			if key is not None and mode != "name":
+				self.keyCache[(mode, newname)] = key[:2] + (natural_key(newname), newname)
+		return self.add(newname)
+
+	def forget(self, name):
+		for mode, label in self.modes:
+			self.keyCache.pop((mode, name), None)
+
+def dhash(file, size=8):
+	#difference hash, near identical frames differ by a few bits
+	with Image.open(file) as im:
+		im.draft("L", (size*4, size*4))
+		im = im.convert("L").resize((size+1, size), Image.BILINEAR)
+		px = list(im.getdata())
+	bits = 0
+	for row in range(size):
+		for col in range(size):
+			i = row*(size+1)+col
+			bits = bits << 1 | (px[i] > px[i+1])
+	return bits
+
+def capture_time(path):
+	t = metadataCache.exif(path)["date"]
+	if t is None:
+		try:
+			t = metadataCache.getmtime(path)
+		except OSError:
+			t = 0
+	return t
+
+class PhotoGroups(object):
+	#bursts are split by short time gaps (and optionally by content), events by long ones
+	levels = [("burst", "bursts"), ("event", "events")]
+
+	def __init__(self, burstGap=2.0, eventGap=2*3600.0, hashThreshold=12):
+		self.burstGap = burstGap
+		self.eventGap = eventGap
+		self.hashThreshold = hashThreshold
+		self.folder = None
+		self.groups = {"burst":[], "event":[]}
+		self.index = {"burst":{}, "event":{}}
+		self.hashes = {}
+
+	def hash(self, name):
+		h = self.hashes.get(name)
+		if h is None:
+			try:
+				h = dhash(os.path.join(self.folder, name))
+			except Exception:
+				h = 0
+			self.hashes[name] = h
+		return h
+
+	def similar(self, name1, name2):
+		return bin(self.hash(name1) ^ self.hash(name2)).count("1") <= self.hashThreshold
+
+	def build(self, folder, names, useHash=False):
+		self.folder = folder
+		times = sorted((capture_time(os.path.join(folder, n)), natural_key(n), n) for n in names)
+
+		bursts = []
+		events = []
+		previous = None
+		for t, key, name in times:
+			if previous is None or t - previous[0] > self.eventGap:
+				events.append([])
+				bursts.append([])
+			elif t - previous[0] > self.burstGap:
+				bursts.append([])
+			elif useHash and not self.similar(previous[1], name):
+				bursts.append([])
+			events[-1].append(name)
+			bursts[-1].append(name)
+			previous = (t, name)
+
+		self.groups = {"burst":bursts, "event":events}
+		self.reindex()
+
+	def reindex(self):
+		for level, groups in self.groups.items():
+			self.index[level] = {}
+			for i, group in enumerate(groups):
+				for name in group:
+					self.index[level][name] = i
+
+	def groupOf(self, name, level):
+		i = self.index[level].get(name)
+		if i is None:
+			return []
+		return self.groups[level][i]
+
+	def position(self, name, level):
+		return self.index[level].get(name), len(self.groups[level])
+
+	def neighborGroup(self, name, level, step):
+		#first photo of the group step groups away
+		i = self.index[level].get(name)
+		if i is None or i+step < 0 or i+step >= len(self.groups[level]):
+			return None
+		return self.groups[level][i+step][0]
+
+	def renamed(self, oldname, newname):
+		for level, index in self.index.items():
+			i = index.pop(oldname, None)
+			if i is not None:
+				group = self.groups[level][i]
+				group[group.index(oldname)] = newname
+				index[newname] = i
+		if oldname in self.hashes:
+			self.hashes[newname] = self.hashes.pop(oldname)
+
+	def removed(self, name):
+		for level, index in self.index.items():
+			i = index.pop(name, None)
+			if i is not None:
+				self.groups[level][i].remove(name)
+		#empty groups shift the numbers of the following ones
+		for level in self.groups:
+			self.groups[level] = [g for g in self.groups[level] if g]
+		self.reindex()
+
+def decode_image(file, thumbnail=False):
+	reader = QImageReader(file)
+	if thumbnail:
+		#jpeg readers decode directly at a reduced scale, which is much cheaper
+		size = reader.size()
+		if size.isValid():
+			reader.setScaledSize(size.scaled(320, 320, Qt.KeepAspectRatio))
+	return reader.read()
+
+def shared_mode(im):
+	#the gui sizes the segment from the header with the same rule the worker converts with
+	if im.mode in ("RGBA", "LA", "PA") or "transparency" in im.info:
+		return "RGBA"
+	return "RGB"
+
+def decode_shared(file, thumbnail, name, capacity):
+	#runs in a worker process, the pixels go into the segment the gui created
+	with Image.open(file) as im:
+		if thumbnail:
+			im.draft("RGB", (320, 320))
+			im.thumbnail((320, 320))
+		im = im.convert(shared_mode(im))
+		data = im.tobytes()
+	if len(data) > capacity:
+		raise ValueError("%s decodes larger than its header says" % file)
+
+	#the gui keeps its own handle open, closing ours never destroys the segment, even on windows
+	shm = shared_memory.SharedMemory(name=name)
+	shm.buf[:len(data)] = data
+	shm.close()
+	return im.width, im.height, im.mode
+
+def release_shared(shm):
+	shm.close()
+	#windows removes a segment with its last handle, elsewhere it has to be unlinked
+	if os.name != "nt":
+		try:
+			shm.unlink()
+		except FileNotFoundError:
+			pass
+
+def shared_qimage(shm, width, height, mode):
+	#the mapping stays valid after unlink, nothing is left behind if we crash
+	if os.name != "nt":
+		shm.unlink()
+	if mode == "RGBA":
+		fmt, depth = QImage.Format_RGBA8888, 4
+	else:
+		fmt, depth = QImage.Format_RGB888, 3
+	#the QImage wraps the shared buffer without copying it, the segment lives as long as the image
+	image = QImage(sip.voidptr(shm.buf), width, height, width*depth, fmt)
+	image._shm = shm
+	return image
+
+class ThreadDecoder(object):
+	def decode(self, file, thumbnail):
+		return decode_image(file, thumbnail)
+
+	def shutdown(self):
+		pass
+
+class ProcessDecoder(object):
+	def __init__(self, workers):
+		#forking a process running Qt threads is unsafe
+		self.pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"))
+		self.lock = threading.Lock()
+		#segments of the decodes in flight -> their futures, shutdown releases those nobody maps
+		self.segments = {}
+		self.closed = False
+
+	def decode(self, file, thumbnail):
+		try:
+			with Image.open(file) as im:
+				mode = shared_mode(im)
+				width, height = (320, 320) if thumbnail else im.size
+		except Image.UnidentifiedImageError:
+			#formats PIL does not know may still be readable by Qt
+			return decode_image(file, thumbnail)
+		depth = 4 if mode == "RGBA" else 3
+		capacity = width * height * depth
+
+		shm = shared_memory.SharedMemory(create=True, size=max(capacity, 1))
+		with self.lock:
+			if self.closed:
+				release_shared(shm)
+				return QImage()
+			future = self.pool.submit(decode_shared, file, thumbnail, shm.name, capacity)
+			self.segments[shm] = future
+		try:
+			width, height, mode = future.result()
+			error = None
+		except Exception as e:
+			error = e
+
+		with self.lock:
+			if self.segments.pop(shm, None) is None:
+				#shutdown took the segment over meanwhile
+				return QImage()
+		if error is not None:
+			release_shared(shm)
+			print("failed to decode %s in a worker: %s" % (file, error))
+			return decode_image(file, thumbnail)
+		return shared_qimage(shm, width, height, mode)
+
+	def shutdown(self):
+		with self.lock:
+			self.closed = True
+			segments = list(self.segments.items())
+			self.segments = {}
+		self.pool.shutdown(wait=False, cancel_futures=True)
+		#released once their worker is done with them, cancelled ones right away
+		for shm, future in segments:
+			future.add_done_callback(lambda f, shm=shm:release_shared(shm))
+
+def make_decoder(workers):
+	if os.environ.get("PHOTORENAMER_DECODER", "process") == "process":
+		try:
+			return ProcessDecoder(workers)
+		except Exception as e:
+			print(e)
+			print("failed to start decoding processes. Decoding in threads.")
+	return ThreadDecoder()
+
+class ImageLoader(QObject):
+	#kind, file, generation, image
+	loaded = pyqtSignal(str, str, int, object)
+
+	def __init__(self, workers=None):
+		super(ImageLoader, self).__init__()
+		if workers is None:
+			workers = max(2, os.cpu_count() or 1)
+		self.decoder = make_decoder(workers)
+		self.condition = threading.Condition()
+		self.queue = []
+		self.inflight = {}
+		self.validSince = {}
+		self.generation = 0
+		self.running = True
+		self.threads = []
+		for i in range(workers):
+			t = threading.Thread(target=self.run, daemon=True)
+			t.start()
+			self.threads.append(t)
+
+	def request(self, file, prefetch=(), thumbnail=True):
+		#every request replaces the pending queue, stale requests are never decoded
+		with self.condition:
+			self.generation += 1
+			jobs = []
+			if file:
+				if thumbnail:
+					jobs.append(("thumb", file))
+				jobs.append(("full", file))
+			for f in prefetch:
+				jobs.append(("full", f))
+			self.queue = [(k, f, self.generation) for k, f in jobs if not self.isRunning(k, f)]
+			self.condition.notify_all()
+			return self.generation
+
+	def isRunning(self, kind, file):
+		generation = self.inflight.get((kind, file))
+		return generation is not None and generation >= self.validSince.get(file, 0)
+
+	def isIdle(self):
+		with self.condition:
+			return not self.queue and not self.inflight
+
+	def invalidate(self, file):
+		#results of decodes started before this call are stale
+		with self.condition:
+			self.validSince[file] = self.generation+1
+
+	def isStale(self, file, generation):
+		return generation < self.validSince.get(file, 0)
+
+	def run(self):
+		while True:
+			with self.condition:
+				while self.running and not self.queue:
+					self.condition.wait()
+				if not self.running:
+					return
+				kind, file, generation = self.queue.pop(0)
+				self.inflight[(kind, file)] = generation
+
+			image = self.decode(kind, file)
+
+			with self.condition:
+				self.inflight.pop((kind, file), None)
+				if not self.running:
+					return
+			self.loaded.emit(kind, file, generation, image)
+
+	def decode(self, kind, file):
+		try:
+			return self.decoder.decode(file, kind == "thumb")
+		except Exception as e:
+			print(e)
+			return QImage()
+
+	def stop(self):
+		with self.condition:
+			self.running = False
+			self.queue = []
+			self.condition.notify_all()
+		self.decoder.shutdown()
+
 class FolderBrowser(QWidget):
 	folderChanged = pyqtSignal(str)
 	refreshPrompt = pyqtSignal()
+	sortChanged = pyqtSignal(str)
+	filterChanged = pyqtSignal(str, bool)
 
 	@property
 	def folder(self):
@@ -77,6 +1145,21 @@ class FolderBrowser(QWidget):
 		self.folderRefreshBtn.clicked.connect(self.refresh)
 		self.layout().addWidget(self.folderRefreshBtn)
 
+		self.sortCombo = QComboBox()
+		for mode, label in ImageOrder.modes:
+			self.sortCombo.addItem(label, mode)
+		self.sortCombo.currentIndexChanged.connect(self.sortChange)
+		self.layout().addWidget(self.sortCombo)
+
+		self.searchEdit = QLineEdit("")
+		self.searchEdit.setPlaceholderText("paris and (victor or justine) and not curu")
+		self.searchEdit.editingFinished.connect(self.filterChange)
+		self.layout().addWidget(self.searchEdit)
+
+		self.untaggedCheck = QCheckBox("untagged only")
+		self.untaggedCheck.toggled.connect(self.filterChange)
+		self.layout().addWidget(self.untaggedCheck)
+
 	def browse_(self):
 		folder = str(QFileDialog.getExistingDirectory(parent = self, directory=self.folder, caption="Select Directory"))
 		if folder:
@@ -88,8 +1171,19 @@ class FolderBrowser(QWidget):
 	def refresh(self):
 		self.refreshPrompt.emit()
 
+	def sortChange(self, index):
+		self.sortChanged.emit(self.sortCombo.itemData(index))
+
+	def filterChange(self):
+		self.filterChanged.emit(self.searchEdit.text(), self.untaggedCheck.isChecked())
+
+	def setFilterValid(self, valid):
+		self.searchEdit.setStyleSheet("" if valid else "QLineEdit { background: rgb(120, 40, 40); }")
+
 
 class ImageDisplay(QWidget):
+	imageChanged = pyqtSignal(str)
+
 	@property
 	def currentFile(self):
 		try:
@@ -104,6 +1198,29 @@ class ImageDisplay(QWidget):
 		except:
 			return None
 
+	@property
+	def images(self):
+		#with a filter, navigation only goes through the matching images
+		if self.filter is None:
+			return self.order.names
+		if self.viewVersion != self.order.version:
+			self.view = [n for n in self.order.names if n in self.filter]
+			self.viewKeys = [self.order.sortKey(n) for n in self.view]
+			self.viewVersion = self.order.version
+		return self.view
+
+	def isShown(self, name):
+		return self.filter is None or name in self.filter
+
+	def indexOf(self, name):
+		if self.filter is None:
+			return self.order.index(name)
+		images = self.images
+		i = bisect.bisect_left(self.viewKeys, self.order.sortKey(name))
+		if i < len(images) and images[i] == name:
+			return i
+		raise ValueError("%s is not shown" % name)
+
 	@property 
 	def folder(self):
 		return self._folder
@@ -129,7 +1246,7 @@ class ImageDisplay(QWidget):
 		size = QSize(0, 0)
 		sw = self.width()-20
 		sh = self.height()-40
-		if sh:
+		if sh and self.pixmap is not None and self.pixmap.height():
 			sr = sw/sh
 
 			w = self.pixmap.width()
@@ -146,11 +1263,24 @@ class ImageDisplay(QWidget):
 
 	def __init__(self, folder):
 		super(ImageDisplay, self).__init__()
-		self.acceptable_formats = ["JPG", "JPEG", "PNG", "GIF", "WEBP", "TIFF", "PSD",
-						"RAW", "BMP", "HEIF", "INDD", "JPEG 2000", "SVG", 
-						"AI", "EPS", "PDF", "EXR", "TGA"]
-		self.images = []
+		self.acceptable_formats = list(PHOTO_FORMATS)
+		self.order = ImageOrder(folder)
+		self.shots = ShotIndex(self.acceptable_formats)
+		self.tokens = TokenIndex()
+		self.query = None
+		self.filter = None
+		self.view = []
+		self.viewKeys = []
+		self.viewVersion = -1
 		self._id = 0
+		self.pixmap = None
+		self.pixmapFile = None
+		#false while only a thumbnail of the current image is available
+		self.pixmapFull = False
+		self.prefetchCount = 2
+
+		self.loader = ImageLoader()
+		self.loader.loaded.connect(self.imageLoaded)
 
 		self.setLayout(QHBoxLayout())
 
@@ -187,6 +1317,9 @@ class ImageDisplay(QWidget):
 		self.rightBtn.setEnabled(False)
 		self.rightBtn.setStyleSheet(" font-size: 40px; ")
 		self.layout().addWidget(self.rightBtn)
+
+		self.leftShortcut = QShortcut(QKeySequence(Qt.Key_Left), self, self.previousPhoto)
+		self.rightShortcut = QShortcut(QKeySequence(Qt.Key_Right), self, self.nextPhoto)
 		self.folder = folder
 
 
@@ -197,33 +1330,118 @@ class ImageDisplay(QWidget):
 
 	def display(self):
 		if self.images:
-			qsize = self.imgSize
-			self.img.resize(qsize)
+			if self.pixmap is not None and not self.pixmap.isNull():
+				qsize = self.imgSize
+				self.img.resize(qsize)
 
-			#this is necessary to allow the widget to shrink down properly
-			self.img.setMinimumSize(1, 1)
+				#this is necessary to allow the widget to shrink down properly
+				self.img.setMinimumSize(1, 1)
 
-			self.img.setPixmap(self.pixmap.scaled(qsize, Qt.KeepAspectRatio))
+				if self.pixmapFull:
+					self.img.setPixmap(self.scaledPixmap(qsize))
+				else:
+					self.img.setPixmap(self.pixmap.scaled(qsize, Qt.KeepAspectRatio))
+			else:
+				self.img.clear()
 			self.label.setText(self.images[self.id])
-			self.handle_buttons()
+		else:
+			self.img.clear()
+			self.label.setText("")
+		self.handle_buttons()
 
 	def init_images(self):
-		files = os.listdir(self.folder)
-		images = []
-		for file in files:
-			name, ext = os.path.splitext(file)
-			if ext.upper()[1::] in self.acceptable_formats:
-				images.append(file)
+		files = metadataCache.listdir(self.folder)
+		shots = ShotIndex(self.acceptable_formats)
+		images = shots.build(files)
 		if images:
-			self.images = images
+			self.shots = shots
+			self.tokens.build(images)
+			self.order.reset(self.folder, images)
+			if self.query is not None:
+				self.filter = self.query.evaluate(self.tokens)
 	
 	def init_id(self):
 		self.id = 0
 
 	def load_img(self):
 		img = self.currentFile
-		if img:
-			self.pixmap = QPixmap(img)
+		if self.pixmapFile and self.pixmapFile != img:
+			#the previous image stays around as a prefetched neighbor until memory is needed
+			memoryBudget.setPriority(("full", self.pixmapFile), MemoryBudget.PRIORITY_PREFETCH)
+			memoryBudget.setPriority(("scaled", self.pixmapFile), MemoryBudget.PRIORITY_PREFETCH)
+		if not img:
+			#an empty folder, or a filter matching nothing
+			self.pixmapFile = None
+			self.pixmap = None
+			self.pixmapFull = False
+			return
+
+		changed = img != self.pixmapFile
+		self.pixmapFile = img
+		if changed:
+			self.imageChanged.emit(img)
+		neighbors = [f for f in self.neighbors() if not ("full", f) in memoryBudget]
+		pixmap = memoryBudget.get(("full", img))
+		if pixmap is not None:
+			if isinstance(pixmap, QImage):
+				#prefetched images are only turned into pixmaps once they are shown
+				pixmap = QPixmap.fromImage(pixmap)
+				memoryBudget.put(("full", img), pixmap, pixmap_bytes(pixmap), MemoryBudget.PRIORITY_CURRENT)
+			else:
+				memoryBudget.setPriority(("full", img), MemoryBudget.PRIORITY_CURRENT)
+			self.pixmap = pixmap
+			self.pixmapFull = True
+			self.loader.request(None, neighbors)
+		else:
+			#the decode happens in the background, a thumbnail stands in until it is done
+			thumb = memoryBudget.get(("thumb", img))
+			self.pixmap = None if thumb is None else QPixmap.fromImage(thumb)
+			self.pixmapFull = False
+			self.loader.request(img, neighbors, thumb is None)
+
+	def neighbors(self):
+		files = []
+		for i in range(1, self.prefetchCount+1):
+			for j in (self.id+i, self.id-i):
+				if j >= 0 and j < len(self.images):
+					files.append(os.path.join(os.sep, self.folder, self.images[j]))
+		return files
+
+	def imageLoaded(self, kind, file, generation, image):
+		if self.loader.isStale(file, generation):
+			return
+		if image.isNull():
+			#nothing better will come for an unreadable file
+			if kind == "full" and file == self.currentFile:
+				self.pixmap = None
+				self.pixmapFull = True
+				self.display()
+			return
+
+		current = file == self.currentFile
+		if kind == "thumb":
+			memoryBudget.put(("thumb", file), image, pixmap_bytes(image), MemoryBudget.PRIORITY_THUMBNAIL)
+			if current and not self.pixmapFull:
+				self.pixmap = QPixmap.fromImage(image)
+				self.display()
+		elif current:
+			pixmap = QPixmap.fromImage(image)
+			memoryBudget.put(("full", file), pixmap, pixmap_bytes(pixmap), MemoryBudget.PRIORITY_CURRENT)
+			self.pixmap = pixmap
+			self.pixmapFull = True
+			self.display()
+		elif file in self.neighbors():
+			memoryBudget.put(("full", file), image, pixmap_bytes(image), MemoryBudget.PRIORITY_PREFETCH)
+
+	def scaledPixmap(self, qsize):
+		key = ("scaled", self.pixmapFile)
+		cached = memoryBudget.get(key)
+		if cached is not None and cached[0] == qsize:
+			memoryBudget.setPriority(key, MemoryBudget.PRIORITY_SCALED)
+			return cached[1]
+		scaled = self.pixmap.scaled(qsize, Qt.KeepAspectRatio)
+		memoryBudget.put(key, (qsize, scaled), pixmap_bytes(scaled), MemoryBudget.PRIORITY_SCALED)
+		return scaled
 
 	def handle_buttons(self):
 		if not len(self.images):
@@ -249,33 +1467,110 @@ class ImageDisplay(QWidget):
 			self.id += 1
 
 	def accept(self, newname):
-		self.images[self.id] = newname
-		self.nextPhoto()
+		nextname = None
+		if self.id+1 < len(self.images):
+			nextname = self.images[self.id+1]
+
+		#the renamed file may move in the order, or leave the filter,
+		#navigation goes on with its former neighbor
+		current = self.renamed(self.currentImage, newname)
+		if nextname is not None:
+			self.id = self.indexOf(nextname)
+		else:
+			self.keepCurrent(current)
+
+	def renamed(self, oldname, newname):
+		#bookkeeping only, returns the name of the current image for the caller to show
+		current = self.currentImage
+		oldfile = os.path.join(os.sep, self.folder, oldname)
+		newfile = os.path.join(os.sep, self.folder, newname)
+		self.shots.renamed(oldname, newname)
+		self.order.replace(oldname, newname)
+		self.indexRemove(oldname)
+		self.indexAdd(newname)
+		memoryBudget.rekey(oldfile, newfile)
+		if current == oldname:
+			current = newname
+			if self.pixmapFile == oldfile:
+				self.pixmapFile = newfile
+		return current
+
+	def indexAdd(self, name):
+		self.tokens.add(name)
+		if self.query is not None and self.query.matches(name, self.tokens.tokens[name]):
+			self.filter.add(name)
+			self.viewVersion = -1
+
+	def indexRemove(self, name):
+		self.tokens.remove(name)
+		if self.filter is not None and name in self.filter:
+			self.filter.discard(name)
+			self.viewVersion = -1
+
+	def setQuery(self, query):
+		current = self.currentImage
+		self.query = query
+		if query is None:
+			self.filter = None
+		else:
+			self.filter = query.evaluate(self.tokens)
+		self.viewVersion = -1
+		self.keepCurrent(current)
+
+	def isSettled(self):
+		return not self.images or (self.pixmapFile == self.currentFile and self.pixmapFull)
+
+	def companionFiles(self, name):
+		return [os.path.join(os.sep, self.folder, n) for n in self.shots.files(name)[1::]]
+
+	def showImage(self, name):
+		try:
+			self.id = self.indexOf(name)
+		except ValueError:
+			pass
 
 	def refreshFile(self):
+		memoryBudget.discard(self.currentFile)
+		self.loader.invalidate(self.currentFile)
+		self.pixmapFile = None
 		self.load_img()
 		self.display()
 
 	def refresh(self):
-		files = os.listdir(self.folder)
-		new_list = []
+		files = metadataCache.scan(self.folder)
+		current = self.currentImage
+
+		images = set(self.shots.build(files))
+
 		#removing old images
-		for i, image in enumerate(self.images):
-			if image in files:
-				new_list.append(image)
-				if i == self.id:
-					self.id_ = len(new_list)-1
+		for image in [x for x in self.order.names if not x in images]:
+			self.order.remove(image)
+			self.indexRemove(image)
 
 		#adding new images
-		for file in files:
-			if not file in new_list:
-				name, ext = os.path.splitext(file)
-				if ext.upper()[1::] in self.acceptable_formats:
-					new_list.append(file)
+		known = set(self.order.names)
+		for image in images:
+			if not image in known:
+				self.order.add(image)
+				self.indexAdd(image)
+
+		self.keepCurrent(current)
 
-		self.images = new_list
+	def keepCurrent(self, current):
+		try:
+			if current is None:
+				raise ValueError("no current image")
+			self._id = self.indexOf(current)
+		except ValueError:
+			self._id = max(0, min(self.id, len(self.images)-1))
+			self.load_img()
 		self.display()
 
+	def setSortMode(self, mode):
+		current = self.currentImage
+		self.order.setMode(mode)
+		self.keepCurrent(current)
+
 	def resizeImages(self):
 		self.display()
 
@@ -284,7 +1579,10 @@ class ImageDisplay(QWidget):
 		super(ImageDisplay, self).resizeEvent(e)
 
 	def discardCurrent(self):
-		del self.images[self.id]
+		memoryBudget.discard(self.currentFile)
+		self.shots.removed(self.currentImage)
+		self.indexRemove(self.currentImage)
+		self.order.remove(self.currentImage)
 		if self.id < len(self.images):
 			self.id = self.id
 		else:
@@ -351,9 +1649,13 @@ class RenamableLabel(QWidget):
 
 class Tag(QWidget):
 	deleteSg = pyqtSignal()
-	def __init__(self, name, checked=False):
+	#true to attach the current photo's location, false once locations were cleared
+	locateSg = pyqtSignal(bool)
+	def __init__(self, name, checked=False, points=None):
 		super(Tag, self).__init__()
 		self.name = name
+		#locations, as {"lat", "lon", "radius"} in km, where this tag applies
+		self.points = points or []
 
 		self.setLayout(QHBoxLayout())
 		self.layout().setSpacing(0)
@@ -375,8 +1677,28 @@ class Tag(QWidget):
 	def isChecked(self):
 		return self.chk.isChecked()
 
+	def setChecked(self, checked):
+		self.chk.setChecked(checked)
+
+	def contextMenuEvent(self, event):
+		contextMenu = QMenu(self)
+		locateAct = contextMenu.addAction("Use the current photo's location")
+		clearAct = None
+		if self.points:
+			clearAct = contextMenu.addAction("Forget locations (%d)" % len(self.points))
+		action = contextMenu.exec_(self.mapToGlobal(event.pos()))
+		if action == locateAct:
+			self.locateSg.emit(True)
+		elif action is not None and action == clearAct:
+			self.points = []
+			self.locateSg.emit(False)
+
+#configs saved before tabs had a places flag matched the gazetteer on these titles
+PLACE_TABS = ["place", "places"]
+
 class TagsTemplate(QWidget):
 	tabDeletedSg = pyqtSignal()
+	tagLocateSg = pyqtSignal(object, bool)
 	@property
 	def name(self):
 		return self.title.text()
@@ -391,6 +1713,8 @@ class TagsTemplate(QWidget):
 	
 	def __init__(self, name, names):
 		super(TagsTemplate, self).__init__()
+		#tags of a places tab are checked when the gazetteer knows their name
+		self.places = False
 
 		stylesheet = """
 			QWidget {
@@ -471,9 +1795,24 @@ class TagsTemplate(QWidget):
 			w = Tag(txt)
 			self.widget.layout().insertWidget(len(self.widgets), w)
 			self.widgets.append(w)
-			w.deleteSg.connect(lambda x=w:self.deleteWidget(x))
+			self.registerTag(w)
 			self.extraEdit.clear()
 
+	def registerTag(self, w):
+		w.deleteSg.connect(lambda x=w:self.deleteWidget(x))
+		w.locateSg.connect(lambda add, x=w:self.tagLocateSg.emit(x, add))
+
+	@property
+	def isPlaceTab(self):
+		return self.places
+
+	def autoCheck(self, places, isKnown):
+		#only tags located by the user, or gazetteer places in a place tab, are touched
+		#a person tag may share its name with some village, it stays as the user left it
+		for w in self.widgets:
+			if w.points or (self.isPlaceTab and isKnown(w.name.lower())):
+				w.setChecked(w.name.lower() in places)
+
 	def tags(self, file):
 		return self.checkedNames()
 
@@ -483,9 +1822,11 @@ class TagsTemplate(QWidget):
 	def state(self):
 		output = []
 		for w in self.widgets:
-			output.append(
-			{"name":w.name,
-			"checked":w.isChecked()})
+			tag = {"name":w.name,
+				"checked":w.isChecked()}
+			if w.points:
+				tag["points"] = w.points
+			output.append(tag)
 		return output
 
 	def addWidget(self, w):
@@ -496,9 +1837,16 @@ class TagsTemplate(QWidget):
 
 	def contextMenuEvent(self, event):
 		contextMenu = QMenu(self)
+		placesAct = None
+		if self.tabType == "TagsTab":
+			placesAct = contextMenu.addAction("Places Tab")
+			placesAct.setCheckable(True)
+			placesAct.setChecked(self.places)
 		deleteAct = contextMenu.addAction("Delete Tab")
 		action = contextMenu.exec_(self.mapToGlobal(event.pos()))
-		if action == deleteAct:
+		if action is not None and action == placesAct:
+			self.places = placesAct.isChecked()
+		elif action == deleteAct:
 			ret = QMessageBox.question(self,'', "Do you really want to delete the tab?", QMessageBox.Yes | QMessageBox.No)
 			if ret == QMessageBox.Yes:
 				self.tabDeletedSg.emit()
@@ -508,8 +1856,9 @@ class TagsTab(TagsTemplate):
 	def tabType(self):
 		return "TagsTab"
 
-	def __init__(self, name, names):
+	def __init__(self, name, names, places=False):
 		super(TagsTab, self).__init__(name, names)
+		self.places = places
 
 		# stylesheet = """
 		# 	QWidget {
@@ -558,11 +1907,11 @@ class TagsTab(TagsTemplate):
 		# self.setStyleSheet(stylesheet)
 
 		for i in names:
-			w = Tag(i["name"], i["checked"])
+			w = Tag(i["name"], i["checked"], i.get("points"))
 			self.addWidget(w)
 			self.widgets.append(w)
 
-			w.deleteSg.connect(lambda x=w:self.deleteWidget(x))
+			self.registerTag(w)
 
 		self.extraEdit = QLineEdit()
 		self.extraEdit.returnPressed.connect(self.addName)
@@ -589,37 +1938,10 @@ class DateTab(TagsTemplate):
 	def tags(self, file):
 		txt = self.dateEdit.text()
 		if txt:
-			date = os.path.getmtime(file)
-			gmtime = time.gmtime(date)
-
-			year = time.strftime("%Y", gmtime)
-			month = time.strftime("%m", gmtime)
-			day = time.strftime("%d", gmtime)
-
-			tmpstr = txt[::-1]
-
-			reay = year[::-1]
-			while(re.search("Y", tmpstr)):
-				if not len(reay):
-					reay = "0"
-				tmpstr = re.sub(r"Y", reay[0], tmpstr, 1, re.MULTILINE)
-				reay = reay[1::]
-
-			htnom = month[::-1]
-			while(re.search("M", tmpstr)):
-				if not len(htnom):
-					htnom = "0"
-				tmpstr = re.sub(r"M", htnom[0], tmpstr, 1, re.MULTILINE)
-				htnom = htnom[1::]
-
-			yad = day[::-1]
-			while(re.search("D", tmpstr)):
-				if not len(yad):
-					yad = "0"
-				tmpstr = re.sub(r"D", yad[0], tmpstr, 1, re.MULTILINE)
-				yad = yad[1::]
-
-			return [tmpstr[::-1]]
+			try:
+				return [date_tag(txt, metadataCache.getmtime(file))]
+			except OSError as e:
+				print(e)
 		return []
 
 	def state(self):
@@ -630,6 +1952,8 @@ class NewTabDialog(QDialog):
 	def tab(self):
 		if self.regularTabRdb.isChecked():
 			return "regular"
+		elif self.placesTabRdb.isChecked():
+			return "places"
 		elif self.dateTabRdb.isChecked():
 			return "date"
 	
@@ -638,8 +1962,10 @@ class NewTabDialog(QDialog):
 		self.setLayout(QVBoxLayout())
 		self.regularTabRdb = QRadioButton("regular tab")
 		self.regularTabRdb.setChecked(Qt.Checked)
+		self.placesTabRdb = QRadioButton("places tab")
 		self.dateTabRdb = QRadioButton("date tab")
 		self.layout().addWidget(self.regularTabRdb)
+		self.layout().addWidget(self.placesTabRdb)
 		self.layout().addWidget(self.dateTabRdb)
 
 		self.btnLayout = QHBoxLayout()
@@ -654,12 +1980,15 @@ class NewTabDialog(QDialog):
 		self.btnLayout.addWidget(self.cancelBtn)
 
 class TagsManager(QWidget):
+	tagLocateSg = pyqtSignal(object, bool)
 	@property
 	def state(self):
 		output = []
 		for w in self.tagstabs:
 			tab = {"name":w.name, "content":[], "type":w.tabType}
 			tab["content"] = w.state()
+			if w.places:
+				tab["places"] = True
 			output.append(tab)
 		return output
 	
@@ -676,10 +2005,12 @@ class TagsManager(QWidget):
 					if tab["type"] == "DateTab":
 						w = DateTab(tab["content"])
 						w.tabDeletedSg.connect(lambda x=w:self.tabDelete(x))
+						w.tagLocateSg.connect(self.tagLocateSg)
 						widgets.append(w)
 					elif tab["type"] == "TagsTab":
-						w = TagsTab(tab["name"], tab["content"])
+						w = TagsTab(tab["name"], tab["content"], tab.get("places", tab["name"].lower() in PLACE_TABS))
 						w.tabDeletedSg.connect(lambda x=w:self.tabDelete(x))
+						w.tagLocateSg.connect(self.tagLocateSg)
 						widgets.append(w)
 
 				for w in widgets:
@@ -699,13 +2030,14 @@ class TagsManager(QWidget):
 					tags = [{"name":"Dunkerque", "checked":False}, 
 							{"name":"Paris", "checked":False},
 							{"name":"Montreal", "checked":False}]
-					w = TagsTab(nm, tags)
+					w = TagsTab(nm, tags, True)
 				if i == 2:
 					tags = [{"name":"Justine", "checked":False}, 
 							{"name":"Victor", "checked":False},
 							{"name":"Curu", "checked":False}]
 					w = TagsTab(nm, tags)
 
+				w.tagLocateSg.connect(self.tagLocateSg)
 				self.tagstabs.append(w)
 				self.layout().addWidget(w)
 
@@ -733,29 +2065,420 @@ class TagsManager(QWidget):
 		dialog = NewTabDialog()
 		ret = dialog.exec()
 		if ret:
-			if dialog.tab == "regular":
-				w = TagsTab("misc", [])
+			if dialog.tab in ("regular", "places"):
+				places = dialog.tab == "places"
+				w = TagsTab("places" if places else "misc", [], places)
 				w.tabDeletedSg.connect(lambda x=w:self.tabDelete(x))
+				w.tagLocateSg.connect(self.tagLocateSg)
 				self.tagstabs.append(w)
 				self.layout().insertWidget(len(self.tagstabs)-1, w)
 			elif dialog.tab == "date":
 				w = DateTab("YYYY_MM")
 				w.tabDeletedSg.connect(lambda x=w:self.tabDelete(x))
+				w.tagLocateSg.connect(self.tagLocateSg)
 				self.tagstabs.append(w)
 				self.layout().insertWidget(len(self.tagstabs)-1, w)
 
+	def checkedNames(self):
+		return [t.name for tab in self.tagstabs for t in tab.widgets if t.isChecked()]
+
+	def setCheckedNames(self, names):
+		for tab in self.tagstabs:
+			for t in tab.widgets:
+				t.setChecked(t.name in names)
+
+	def locatedTags(self):
+		return [t for tab in self.tagstabs for t in tab.widgets if t.points]
+
+	def tagNames(self):
+		return [t.name for tab in self.tagstabs for t in tab.widgets]
+
+	def dateTemplates(self):
+		return [tab.dateEdit.text() for tab in self.tagstabs if tab.tabType == "DateTab"]
+
+	def autoCheck(self, places, isKnown):
+		for tab in self.tagstabs:
+			tab.autoCheck(places, isKnown)
+
 	def acceptTabsNames(self):
 		for tab in self.tagstabs:
 			if tab.title.isEditted():
 				tab.title.completeEdit()
 
+def date_tag(template, date):
+	#YYYY_MM -> 2026_10, the digits are taken from the right
+	gmtime = time.gmtime(date)
+
+	year = time.strftime("%Y", gmtime)
+	month = time.strftime("%m", gmtime)
+	day = time.strftime("%d", gmtime)
+
+	tmpstr = template[::-1]
+
+	reay = year[::-1]
+	while(re.search("Y", tmpstr)):
+		if not len(reay):
+			reay = "0"
+		tmpstr = re.sub(r"Y", reay[0], tmpstr, 1, re.MULTILINE)
+		reay = reay[1::]
+
+	htnom = month[::-1]
+	while(re.search("M", tmpstr)):
+		if not len(htnom):
+			htnom = "0"
+		tmpstr = re.sub(r"M", htnom[0], tmpstr, 1, re.MULTILINE)
+		htnom = htnom[1::]
+
+	yad = day[::-1]
+	while(re.search("D", tmpstr)):
+		if not len(yad):
+			yad = "0"
+		tmpstr = re.sub(r"D", yad[0], tmpstr, 1, re.MULTILINE)
+		yad = yad[1::]
+
+	return tmpstr[::-1]
+
+def state_tags(state, date):
+	#the tags TagsManager.tags gives for a saved state, without building the widgets
+	tags = []
+	for tab in state or []:
+		if tab["type"] == "DateTab":
+			if tab["content"]:
+				tags.append(date_tag(tab["content"], date))
+		elif tab["type"] == "TagsTab":
+			tags += [t["name"] for t in tab["content"] if t.get("checked")]
+	return tags
+
+def unique_stem(tags, isTaken):
+	#Paris_Victor, then Paris_Victor_2, Paris_Victor_3...
+	newname = "_".join(tags)
+	fileId = 1
+	while(isTaken(newname)):
+		fileId += 1
+		newname = "_".join(tags)+"_"+str(fileId)
+	return newname
+
+def config_path():
+	return os.path.join(os.path.expanduser("~"), ".photorenamerconfig")
+
+def load_state(configFile=None):
+	configFile = configFile or config_path()
+	if os.path.isfile(configFile):
+		with open(configFile, 'r') as f:
+			return json.load(f)
+
+def rotate_file(path, direction):
+	im = Image.open(path)
+	if direction == 1:
+		im = im.transpose(Image.ROTATE_270)
+	elif direction == -1:
+		im = im.transpose(Image.ROTATE_90)
+	im.save(path)
+
+class FileOperation(object):
+	#companions are (source, target) pairs for renames and paths for deletions
+	def __init__(self, kind, path, target=None, direction=0, companions=()):
+		self.kind = kind
+		self.path = path
+		self.target = target
+		self.direction = direction
+		self.companions = list(companions)
+		self.status = "pending"
+		self.error = None
+		self.chain = None
+		#operations of other chains that must free a path first, and the ones waiting on this one
+		self.after = []
+		self.waiting = []
+		#a failed rename the viewer shows under the old name again
+		self.reverted = False
+
+	def frees(self):
+		if self.kind in ("rename", "move"):
+			return [self.path] + [a for a, b in self.companions]
+		if self.kind == "delete":
+			return [self.path] + self.companions
+		return []
+
+	def claims(self):
+		if self.kind in ("rename", "move"):
+			return [self.target] + [b for a, b in self.companions]
+		return []
+
+	def __str__(self):
+		name = os.path.basename(self.path)
+		if self.kind in ("rename", "move"):
+			text = "%s %s to %s" % (self.kind, name, os.path.basename(self.target))
+		else:
+			text = "%s %s" % (self.kind, name)
+		if self.companions:
+			text += " (+%d companion files)" % len(self.companions)
+		return text
+
+	def run(self, trash=send2trash):
+		if self.kind in ("rename", "move"):
+			pairs = [(self.path, self.target)] + self.companions
+			#os.rename silently replaces existing files on some systems
+			for source, target in pairs:
+				if os.path.exists(target):
+					raise FileExistsError("%s already exists" % target)
+			#a move may leave the filesystem, os.rename cannot
+			move = os.rename
+			if self.kind == "move":
+				os.makedirs(os.path.dirname(self.target), exist_ok=True)
+				move = shutil.move
+			done = []
+			try:
+				for source, target in pairs:
+					move(source, target)
+					done.append((source, target))
+			except Exception:
+				#the files of a shot keep sharing a name
+				for source, target in reversed(done):
+					move(target, source)
+				raise
+		elif self.kind == "rotate":
+			rotate_file(self.path, self.direction)
+		elif self.kind == "delete":
+			for path in [self.path] + self.companions:
+				if os.path.exists(path):
+					trash(path)
+
+class OperationChain(object):
+	#operations on one file, run strictly one after the other
+	def __init__(self, path):
+		self.path = path
+		self.ops = deque()
+
+class FileOperations(QObject):
+	changed = pyqtSignal()
+	finished = pyqtSignal(object)
+	failed = pyqtSignal(object)
+
+	def __init__(self, workers=4):
+		super(FileOperations, self).__init__()
+		self.pool = ThreadPoolExecutor(workers)
+		self.trash = send2trash
+		self.condition = threading.Condition()
+		#current path of a file -> its chain, renames move the chain to the new path
+		self.chains = {}
+		#path -> the queued operation that frees it, a file renamed to that path waits for it
+		self.freeing = {}
+		self.active = []
+		#operations done but whose signals the gui has not handled yet
+		self.reporting = 0
+		self.finished.connect(self.reported)
+		self.failed.connect(self.reported)
+
+	def submit(self, op):
+		with self.condition:
+			key = os.path.normpath(op.path)
+			chain = self.chains.get(key)
+			if chain is None:
+				chain = OperationChain(op.path)
+				self.chains[key] = chain
+				self.active.append(chain)
+			op.chain = chain
+			chain.ops.append(op)
+			for path in op.claims():
+				other = self.freeing.get(os.path.normpath(path))
+				if other is not None and other.chain is not chain:
+					op.after.append(other)
+					other.waiting.append(op)
+			for path in op.frees():
+				self.freeing[os.path.normpath(path)] = op
+			if op.kind == "rename":
+				del self.chains[key]
+				chain.path = op.target
+				self.chains[os.path.normpath(op.target)] = chain
+			if len(chain.ops) == 1:
+				self.start(op)
+		self.changed.emit()
+
+	def start(self, op):
+		#an operation waiting for another chain to free its target is started again by release
+		if op.after:
+			op.status = "blocked"
+			return
+		op.status = "pending"
+		self.pool.submit(self.execute, op)
+
+	def release(self, op):
+		#op is done or dismissed, the paths it was to free will not change anymore
+		for path in op.frees():
+			key = os.path.normpath(path)
+			if self.freeing.get(key) is op:
+				del self.freeing[key]
+		for other in op.waiting:
+			other.after.remove(op)
+			if other.status == "blocked":
+				self.start(other)
+		op.waiting = []
+
+	def execute(self, op):
+		op.status = "running"
+		self.changed.emit()
+		try:
+			op.run(self.trash)
+			op.status = "done"
+			op.error = None
+		except Exception as e:
+			print(e)
+			op.status = "failed"
+			op.error = e
+
+		with self.condition:
+			self.reporting += 1
+			#a failure holds back the following operations on the file until retried or dismissed
+			if op.status == "done":
+				self.advance(op.chain)
+				self.release(op)
+			self.condition.notify_all()
+
+		if op.status == "done":
+			self.finished.emit(op)
+		else:
+			self.failed.emit(op)
+		self.changed.emit()
+
+	def reported(self, op):
+		with self.condition:
+			self.reporting -= 1
+			self.condition.notify_all()
+
+	def advance(self, chain):
+		chain.ops.popleft()
+		if chain.ops:
+			self.start(chain.ops[0])
+		else:
+			self.active.remove(chain)
+			key = os.path.normpath(chain.path)
+			if self.chains.get(key) is chain:
+				del self.chains[key]
+
+	def retry(self, op):
+		with self.condition:
+			if op.status == "failed" and op.chain.ops and op.chain.ops[0] is op:
+				self.start(op)
+		self.changed.emit()
+
+	def dismiss(self, op):
+		with self.condition:
+			if op.status == "failed" and op.chain.ops and op.chain.ops[0] is op:
+				self.advance(op.chain)
+				self.release(op)
+				self.condition.notify_all()
+		self.changed.emit()
+
+	def pending(self):
+		with self.condition:
+			return [op for chain in self.active for op in chain.ops]
+
+	def failures(self):
+		return [op for op in self.pending() if op.status == "failed"]
+
+	def isBusy(self):
+		return self.reporting > 0 or any(chain.ops[0].status not in ("failed", "blocked") for chain in self.active)
+
+	def wait(self, timeout=None):
+		#returns once nothing runs anymore, the gui may still have to handle the results
+		with self.condition:
+			return self.condition.wait_for(lambda:not any(chain.ops[0].status not in ("failed", "blocked") for chain in self.active), timeout)
+
+	def shutdown(self):
+		self.wait()
+		for op in self.pending():
+			if op.status in ("failed", "blocked"):
+				print("not applied: %s (%s)" % (op, op.error or "waiting for another file"))
+		self.pool.shutdown()
+
+class OperationsView(QWidget):
+	dismissed = pyqtSignal(object)
+
+	def __init__(self, operations):
+		super(OperationsView, self).__init__()
+		self.setWindowTitle("File operations")
+		self.resize(500, 300)
+		self.operations = operations
+		self.operations.changed.connect(self.refresh)
+
+		self.setLayout(QVBoxLayout())
+		self.list = QListWidget()
+		self.layout().addWidget(self.list)
+
+		self.btnLayout = QHBoxLayout()
+		self.layout().addLayout(self.btnLayout)
+
+		self.retryBtn = QPushButton("Retry")
+		self.retryBtn.clicked.connect(self.retry)
+		self.btnLayout.addWidget(self.retryBtn)
+
+		self.retryAllBtn = QPushButton("Retry all")
+		self.retryAllBtn.clicked.connect(self.retryAll)
+		self.btnLayout.addWidget(self.retryAllBtn)
+
+		self.dismissBtn = QPushButton("Dismiss")
+		self.dismissBtn.clicked.connect(self.dismiss)
+		self.btnLayout.addWidget(self.dismissBtn)
+
+		self.setStyleSheet(stylesheet)
+		self.refresh()
+
+	def refresh(self):
+		self.list.clear()
+		for op in self.operations.pending():
+			text = "[%s] %s" % (op.status, op)
+			if op.error is not None:
+				text += ": %s" % op.error
+			item = QListWidgetItem(text)
+			item.setData(Qt.UserRole, op)
+			self.list.addItem(item)
+
+	def selected(self):
+		return [item.data(Qt.UserRole) for item in self.list.selectedItems()]
+
+	def retry(self):
+		for op in self.selected():
+			self.operations.retry(op)
+
+	def retryAll(self):
+		for op in self.operations.failures():
+			self.operations.retry(op)
+
+	def dismiss(self):
+		for op in self.selected():
+			if op.status == "failed":
+				self.operations.dismiss(op)
+				self.dismissed.emit(op)
+
+class SessionRecorder(object):
+	#one compact json object per line, folders are only kept as salted hashes
+	def __init__(self, path):
+		self.file = open(path, "w", encoding="utf-8")
+		self.start = time.monotonic()
+		self.salt = os.urandom(8).hex()
+
+	def anonymize(self, path):
+		return hashlib.sha1((self.salt + path).encode("utf-8")).hexdigest()[:10]
+
+	def record(self, action, **args):
+		entry = {"t":round(time.monotonic() - self.start, 3), "a":action}
+		entry.update(args)
+		self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
 class MainWindow(QWidget):
-	def __init__(self, folder):
+	def __init__(self, folder, recorder=None, state=None):
 		super(MainWindow, self).__init__()
+		self.recorder = recorder
 		self.setWindowTitle("Photos renamer")
 		self.resize(1200, 800)
 		self.folder = folder
 		
+		self.groups = None
+
 		self.setLayout(QVBoxLayout())
 
 		self.splitter = QSplitter(Qt.Vertical)
@@ -775,9 +2498,15 @@ class MainWindow(QWidget):
 		self.folderBrowser = FolderBrowser(self.folder)
 		self.folderBrowser.folderChanged.connect(self.folderChange)
 		self.folderBrowser.refreshPrompt.connect(self.refreshPrompt)
+		self.folderBrowser.sortChanged.connect(self.sortChange)
+		self.folderBrowser.filterChanged.connect(self.filterChange)
 		self.topWidget.layout().addWidget(self.folderBrowser)
 
 		self.imageDisplay = ImageDisplay(self.folder)
+		self.imageDisplay.leftBtn.clicked.connect(lambda:self.record("previous"))
+		self.imageDisplay.leftShortcut.activated.connect(lambda:self.record("previous"))
+		self.imageDisplay.rightBtn.clicked.connect(lambda:self.record("next"))
+		self.imageDisplay.rightShortcut.activated.connect(lambda:self.record("next"))
 		self.topWidget.layout().addWidget(self.imageDisplay)
 
 		self.btnLayout = QHBoxLayout()
@@ -807,7 +2536,52 @@ class MainWindow(QWidget):
 		self.rotateImgCClBtn.clicked.connect(lambda:self.rotateImg(-1))
 		self.btnLayout.addWidget(self.rotateImgCClBtn)
 
-		self.btnLayout.addStretch(2)
+		self.btnLayout.addStretch(1)
+
+		self.groupLevelCombo = QComboBox()
+		for level, label in PhotoGroups.levels:
+			self.groupLevelCombo.addItem(label, level)
+		self.groupLevelCombo.currentIndexChanged.connect(self.updateGroupLabel)
+		self.btnLayout.addWidget(self.groupLevelCombo)
+
+		self.groupHashChk = QCheckBox("similar")
+		self.groupHashChk.setToolTip("also split bursts when photos look different")
+		self.groupHashChk.stateChanged.connect(self.invalidateGroups)
+		self.btnLayout.addWidget(self.groupHashChk)
+
+		self.previousGroupBtn = QPushButton("<<")
+		self.previousGroupBtn.setFixedSize(35,35)
+		self.previousGroupBtn.clicked.connect(lambda:self.groupStep(-1))
+		self.btnLayout.addWidget(self.previousGroupBtn)
+
+		self.nextGroupBtn = QPushButton(">>")
+		self.nextGroupBtn.setFixedSize(35,35)
+		self.nextGroupBtn.clicked.connect(lambda:self.groupStep(1))
+		self.btnLayout.addWidget(self.nextGroupBtn)
+
+		self.groupLabel = QLabel("")
+		self.btnLayout.addWidget(self.groupLabel)
+
+		self.renameGroupBtn = QPushButton("Rename group")
+		self.renameGroupBtn.setMinimumHeight(35)
+		self.renameGroupBtn.clicked.connect(self.renameGroup)
+		self.btnLayout.addWidget(self.renameGroupBtn)
+
+		self.btnLayout.addStretch(1)
+
+		#renames, rotations and deletions run in the background, in order for each file
+		self.operations = FileOperations()
+		self.operations.finished.connect(self.operationFinished)
+		self.operations.failed.connect(self.operationFailed)
+		self.operations.changed.connect(self.updateQueueBtn)
+		self.operationsView = OperationsView(self.operations)
+		self.operationsView.dismissed.connect(self.operationDismissed)
+
+		self.queueBtn = QPushButton("")
+		self.queueBtn.setMinimumHeight(35)
+		self.queueBtn.clicked.connect(self.showOperations)
+		self.btnLayout.addWidget(self.queueBtn)
+		self.updateQueueBtn()
 
 		self.renameBtn = QPushButton("Rename")
 		self.renameBtn.setFixedWidth(200)
@@ -819,84 +2593,318 @@ class MainWindow(QWidget):
 
 		self.bottomWidget.layout().addLayout(self.btnLayout)
 
-		self.tagsManager = TagsManager(self.loadState())
+		self.tagsManager = TagsManager(state if state is not None else self.loadState())
+		self.tagsManager.tagLocateSg.connect(self.locateTag)
 		self.bottomWidget.layout().addWidget(self.tagsManager)
 
+		#place tags are checked from the photos' gps, without network
+		self.places = PlaceIndex()
+		if os.path.isfile(gazetteer_path()):
+			try:
+				self.places.load(gazetteer_path())
+			except Exception as e:
+				print(e)
+				print("failed to load the gazetteer. Skipping.")
+		self.updateUserPlaces()
+		#the gps is read once browsing stops on a photo, not for every photo flipped through
+		self.autoTagTimer = QTimer()
+		self.autoTagTimer.setInterval(200)
+		self.autoTagTimer.setSingleShot(True)
+		self.autoTagTimer.timeout.connect(self.autoTagCurrent)
+		self.imageDisplay.imageChanged.connect(lambda file:self.autoTagTimer.start())
+		self.imageDisplay.imageChanged.connect(self.updateGroupLabel)
+		self.autoTagCurrent()
+
 		self.splitter.addWidget(self.topWidget)
 		self.splitter.addWidget(self.bottomWidget)
 		self.splitter.setSizes([800, 100])
+		self.splitter.splitterMoved.connect(lambda:self.record("split", sizes=self.splitter.sizes()))
  		
 		self.layout().addWidget(self.splitter)
 
 		self.setStyleSheet(stylesheet)
 
+		#replays rebuild the same tabs, the recorded tag names would not all exist in another config
+		self.record("state", state=self.tagsManager.state)
+
+	def record(self, action, **args):
+		if self.recorder is not None:
+			self.recorder.record(action, **args)
+
 	def folderChange(self, folder):
 		self.folder = folder
+		self.invalidateGroups()
 		self.imageDisplay.folder = self.folder
+		if self.recorder is not None:
+			self.record("folder", folder=self.recorder.anonymize(folder), images=len(self.imageDisplay.images))
 
 	def refreshPrompt(self):
+		#the refresh button is for changes made outside the tool, the cached listing cannot know them
+		metadataCache.invalidate(self.imageDisplay.folder)
+		self.invalidateGroups()
 		self.imageDisplay.refresh()
 
+	@property
+	def groupLevel(self):
+		return self.groupLevelCombo.currentData()
+
+	def photoGroups(self):
+		#groups are only computed once asked for, it reads the capture date of every file
+		#with a filter they are made of the photos shown, a group rename never touches hidden ones
+		if self.groups is None:
+			self.groups = PhotoGroups()
+			self.groups.build(self.imageDisplay.folder, self.imageDisplay.images, self.groupHashChk.isChecked())
+		return self.groups
+
+	def invalidateGroups(self):
+		self.groups = None
+		self.updateGroupLabel()
+
+	def groupRenamed(self, oldname, newname):
+		#groups are made of the photos shown, a photo the filter now hides leaves its group
+		if self.groups is not None:
+			if self.imageDisplay.isShown(newname):
+				self.groups.renamed(oldname, newname)
+			else:
+				self.groups.removed(oldname)
+
+	def updateGroupLabel(self):
+		current = self.imageDisplay.currentImage
+		if self.groups is None or current is None:
+			self.groupLabel.setText("")
+			return
+		i, count = self.groups.position(current, self.groupLevel)
+		if i is None:
+			self.groupLabel.setText("")
+		else:
+			size = len(self.groups.groupOf(current, self.groupLevel))
+			self.groupLabel.setText("%d/%d (%d photos)" % (i+1, count, size))
+
+	def groupStep(self, step):
+		current = self.imageDisplay.currentImage
+		if current:
+			name = self.photoGroups().neighborGroup(current, self.groupLevel, step)
+			if name:
+				self.imageDisplay.showImage(name)
+			self.updateGroupLabel()
+
+	def renameGroup(self):
+		current = self.imageDisplay.currentImage
+		if not current:
+			return
+		self.flushAutoTag()
+		self.record("renameGroup", level=self.groupLevel, tags=self.tagsManager.checkedNames())
+		groups = self.photoGroups()
+		nextname = groups.neighborGroup(current, self.groupLevel, 1)
+		for name in list(groups.groupOf(current, self.groupLevel)):
+			newname = self.renameFile(os.path.join(os.sep, self.imageDisplay.folder, name))
+			if newname:
+				current = self.imageDisplay.renamed(name, newname)
+				self.groupRenamed(name, newname)
+		#renamed images may have left the filter
+		self.imageDisplay.keepCurrent(current)
+		if nextname:
+			self.imageDisplay.showImage(nextname)
+		self.updateGroupLabel()
+
+	def sortChange(self, mode):
+		self.imageDisplay.setSortMode(mode)
+
+	def filterChange(self, text, untagged):
+		self.record("filter", text=text, untagged=untagged)
+		if not text.strip() and not untagged:
+			query = None
+		else:
+			try:
+				query = TagQuery(text, self.tagsManager.tagNames(), self.tagsManager.dateTemplates())
+			except ValueError as e:
+				print("Invalid query:", e)
+				self.folderBrowser.setFilterValid(False)
+				return
+			if untagged:
+				query.and_(("untagged",))
+		self.folderBrowser.setFilterValid(True)
+		self.imageDisplay.setQuery(query)
+		self.invalidateGroups()
+
+	def updateUserPlaces(self):
+		self.userPlaces = PlaceIndex()
+		for tag in self.tagsManager.locatedTags():
+			for point in tag.points:
+				self.userPlaces.add(tag.name, point["lat"], point["lon"], point.get("radius", 1.0))
+
+	def isKnownPlace(self, name):
+		return name in self.places.names or name in self.userPlaces.names
+
+	def autoTagCurrent(self):
+		self.autoTagTimer.stop()
+		if self.currentFile():
+			self.autoTag(self.currentFile())
+
+	def flushAutoTag(self):
+		#a rename right after browsing uses the places of the photo it renames
+		if self.autoTagTimer.isActive():
+			self.autoTagCurrent()
+
+	def autoTag(self, file):
+		gps = metadataCache.exif(file)["gps"]
+		if gps:
+			places = self.places.resolve(*gps) | self.userPlaces.resolve(*gps)
+			self.tagsManager.autoCheck(places, self.isKnownPlace)
+
+	def locateTag(self, tag, add):
+		if add:
+			currentFile = self.currentFile()
+			gps = metadataCache.exif(currentFile)["gps"] if currentFile else None
+			if not gps:
+				QMessageBox.information(self, '', "The current photo has no GPS location.")
+				return
+			tag.points.append({"lat":gps[0], "lon":gps[1], "radius":1.0})
+		self.updateUserPlaces()
+		self.autoTagCurrent()
+
 	def deleteImg(self):
 		currentFile = self.currentFile()
 		if currentFile:
-			ret = QMessageBox.question(self,'', "Do you really want to delete the file?", QMessageBox.Yes | QMessageBox.No)
+			companions = self.imageDisplay.companionFiles(self.imageDisplay.currentImage)
+			question = "Do you really want to delete the file?"
+			if companions:
+				question = "Do you really want to delete the file and its %d companion files?" % len(companions)
+			ret = QMessageBox.question(self,'', question, QMessageBox.Yes | QMessageBox.No)
 			if ret == QMessageBox.Yes:
-				try:
-					send2trash(currentFile)
-					self.imageDisplay.discardCurrent()
-				except Exception as e:
-					print(e)
-					print("failure to delete the file %s" % currentFile)
+				self.deleteCurrent()
+
+	def deleteCurrent(self):
+		currentFile = self.currentFile()
+		if currentFile:
+			self.record("delete")
+			companions = self.imageDisplay.companionFiles(self.imageDisplay.currentImage)
+			self.operations.submit(FileOperation("delete", currentFile, companions=companions))
+			for path in [currentFile] + companions:
+				metadataCache.removed(path)
+			if self.groups is not None:
+				self.groups.removed(self.imageDisplay.currentImage)
+			self.imageDisplay.discardCurrent()
 
 	def rotateImg(self, direction):
 		currentFile = self.currentFile()
 		if currentFile:
-			try:
-				im = Image.open(currentFile)
-				if direction == 1:
-					im = im.transpose(Image.ROTATE_270)
-				elif direction == -1:
-					im = im.transpose(Image.ROTATE_90)
-				im.save(currentFile)
-				self.imageDisplay.refreshFile()
-			except Exception as e:
-				print(e)
+			self.record("rotate", direction=direction)
+			self.operations.submit(FileOperation("rotate", currentFile, direction=direction))
 
 	def rename(self):
 		currentFile = self.currentFile()
 		if currentFile:
-			tags = self.tagsManager.tags(currentFile)
-			if tags:
-				fullname, ext = os.path.splitext(currentFile)
-				path, name = os.path.split(fullname)
-				newname = "_".join(tags)
-				newfilename = os.path.join(os.sep, path, newname+ext)
-				if newfilename == currentFile:
-					print("Same name requested. Skipping.")
-					return
-				fileId = 1
-				while(os.path.isfile(newfilename)):
-					fileId += 1
-					newname = "_".join(tags)+"_"+str(fileId)
-					newfilename = os.path.join(os.sep, path, newname+ext)
+			self.flushAutoTag()
+			self.record("rename", tags=self.tagsManager.checkedNames())
+			newname = self.renameFile(currentFile)
+			if newname:
+				self.accept(newname)
+
+	def renameFile(self, currentFile):
+		tags = self.tagsManager.tags(currentFile)
+		if tags:
+			fullname, ext = os.path.splitext(currentFile)
+			path, name = os.path.split(fullname)
+			newname = "_".join(tags)
+			newfilename = os.path.join(os.sep, path, newname+ext)
+			if newfilename == currentFile:
+				print("Same name requested. Skipping.")
+				return None
+			newname = unique_stem(tags, lambda stem: self.isNameTaken(path, name+ext, stem))
+
+			#raw twins and sidecars are renamed along with the photo, in one operation
+			pairs = [(os.path.join(os.sep, path, a), os.path.join(os.sep, path, b)) for a, b in self.imageDisplay.shots.targets(name+ext, newname)]
+			newfilename = pairs[0][1]
+
+			#the cache already sees the new name, so the next collision check accounts for it
+			print("renaming %s to %s" %(name+ext, newname+ext))
+			self.operations.submit(FileOperation("rename", currentFile, newfilename, companions=pairs[1::]))
+			for source, target in pairs:
+				metadataCache.renamed(source, target)
+			return newname+ext
+		return None
+
+	def isNameTaken(self, path, name, newstem):
+		#the new name must be free for every file of the shot, and not make it merge with another shot
+		if self.imageDisplay.shots.owner(newstem) not in (None, name):
+			return True
+		for source, target in self.imageDisplay.shots.targets(name, newstem):
+			if metadataCache.isfile(os.path.join(os.sep, path, target)):
+				return True
+		return False
+
+	def operationFinished(self, op):
+		if op.kind == "rename":
+			for source, target in [(op.path, op.target)] + op.companions:
+				metadataCache.settled(target)
+			#a retried rename the view had given up on
+			if op.reverted:
+				op.reverted = False
+				self.applyRename(op.path, op.target)
+		if op.kind == "rotate":
+			#the file may have been renamed meanwhile
+			for path in set([op.path, op.chain.path]):
+				metadataCache.changed(path)
+				if os.path.normpath(path) == os.path.normpath(self.currentFile() or ""):
+					self.imageDisplay.refreshFile()
+				else:
+					memoryBudget.discard(path)
+					self.imageDisplay.loader.invalidate(path)
+
+	def operationFailed(self, op):
+		print("failed to %s" % op)
+		if op.kind == "rename":
+			#the files kept their names, the view shows them so again until a retry succeeds
+			for source, target in [(op.path, op.target)] + op.companions:
+				metadataCache.renamed(target, source)
+				metadataCache.settled(source)
+			op.reverted = True
+			self.applyRename(op.target, op.path)
+		else:
+			#the optimistic view of the folder is wrong until the operation is retried
+			metadataCache.invalidate()
+
+	def applyRename(self, oldpath, newpath):
+		display = self.imageDisplay
+		folder, oldname = os.path.split(os.path.normpath(oldpath))
+		if folder != os.path.normpath(display.folder) or oldname not in display.shots.companions:
+			return
+		newname = os.path.basename(newpath)
+		current = display.renamed(oldname, newname)
+		self.groupRenamed(oldname, newname)
+		display.keepCurrent(current)
+		self.updateGroupLabel()
+
+	def operationDismissed(self, op):
+		self.invalidateGroups()
+		self.imageDisplay.refresh()
 
-				try:
-					print("renaming %s to %s" %(name+ext, newname+ext))
-					os.rename(currentFile, newfilename)
-					self.accept(newname+ext)
-				except Exception as e:
-					print(e)
+	def updateQueueBtn(self):
+		pending = self.operations.pending()
+		failed = len([op for op in pending if op.status == "failed"])
+		if failed:
+			self.queueBtn.setText("queue (%d, %d failed)" % (len(pending), failed))
+			self.queueBtn.setStyleSheet(" color: rgb(224, 104, 104); ")
+		else:
+			self.queueBtn.setText("queue (%d)" % len(pending))
+			self.queueBtn.setStyleSheet("")
+
+	def showOperations(self):
+		self.operationsView.show()
+		self.operationsView.raise_()
 
 	def accept(self, newname):
+		oldname = self.imageDisplay.currentImage
 		self.imageDisplay.accept(newname)
+		self.groupRenamed(oldname, newname)
+		self.updateGroupLabel()
 
 	def currentFile(self):
 		return self.imageDisplay.currentFile
 
 	def saveState(self):
-		home = os.path.expanduser("~")
-		configFile = os.path.join(home, ".photorenamerconfig")
+		configFile = config_path()
 
 		# config = {}
 		# config["tab"] = self.tagsManager.state
@@ -909,18 +2917,25 @@ class MainWindow(QWidget):
 			print("failed to save config")
 
 	def loadState(self):
-		home = os.path.expanduser("~")
-		configFile = os.path.join(home, ".photorenamerconfig")
-		if os.path.isfile(configFile):
-			with open(configFile, 'r') as f:
-				config = json.load(f)
-				return config
+		return load_state()
 
 	def mousePressEvent(self, e):
 		self.tagsManager.acceptTabsNames()
 		super(MainWindow, self).mousePressEvent(e)
 
+	def resizeEvent(self, e):
+		self.record("resize", size=[e.size().width(), e.size().height()])
+		super(MainWindow, self).resizeEvent(e)
+
+	def isSettled(self):
+		return self.imageDisplay.isSettled() and not self.operations.isBusy() and not self.autoTagTimer.isActive()
+
 	def closeEvent(self, e):
+		self.imageDisplay.loader.stop()
+		self.operations.shutdown()
+		self.operationsView.close()
+		if self.recorder is not None:
+			self.recorder.close()
 		self.saveState()
 		super(MainWindow, self).closeEvent(e)
 
@@ -934,9 +2949,521 @@ def resource_path(relative_path):
 
     return os.path.join(base_path, relative_path)
 
+class Inotify(object):
+	#linux only, through libc, the daemon polls where it is missing
+	IN_MODIFY = 0x2
+	IN_CLOSE_WRITE = 0x8
+	IN_MOVED_TO = 0x80
+	IN_CREATE = 0x100
+	IN_Q_OVERFLOW = 0x4000
+	IN_ISDIR = 0x40000000
+	header = struct.Struct("iIII")
+
+	def __init__(self):
+		self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+		self.paths = {}
+
+	def add(self, path):
+		mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+		if wd < 0:
+			raise OSError(ctypes.get_errno(), "cannot watch %s" % path)
+		self.paths[wd] = path
+
+	def read(self, timeout):
+		#yields (path, mask), path is None when the kernel queue overflowed
+		if not select.select([self.fd], [], [], timeout)[0]:
+			return
+		try:
+			data = os.read(self.fd, 65536)
+		except BlockingIOError:
+			return
+		pos = 0
+		while pos < len(data):
+			wd, mask, cookie, length = self.header.unpack_from(data, pos)
+			pos += self.header.size
+			name = os.fsdecode(data[pos:pos+length].rstrip(b"\0"))
+			pos += length
+			if mask & self.IN_Q_OVERFLOW:
+				yield None, mask
+			elif wd in self.paths:
+				yield os.path.join(self.paths[wd], name), mask
+
+	def close(self):
+		os.close(self.fd)
+
+class IngestDaemon(object):
+	#moves settled photos from inbox folders into a target tree, named by a saved tags state
+	def __init__(self, inboxes, target, state, layout="YYYY/MM", log=None, settle=2.0, limit=5000):
+		self.inboxes = [os.path.abspath(x) for x in inboxes]
+		self.target = os.path.abspath(target)
+		self.state = state
+		self.layout = layout
+		self.settle = settle
+		#pending files are bounded, the rest is found again by a rescan once there is room
+		self.limit = limit
+		self.overflow = False
+		self.shots = ShotIndex(PHOTO_FORMATS)
+		#path -> (size, mtime, time of the last change)
+		self.pending = {}
+		#(folder, shot stem) -> pending paths, a shot moves once all its files have settled
+		self.groups = {}
+		#target folder -> shot stems, for the few folders being filled
+		self.stems = {}
+		#path -> (size, mtime) of files skipped or failed, left alone by rescans until they change
+		self.handled = {}
+		#folder -> (time, shot stem -> names), only listed while pending overflows
+		self.listings = {}
+		self.running = True
+		self.log = open(log or os.path.join(self.target, "photorenamer_ingest.jsonl"), "a", encoding="utf-8")
+		try:
+			self.watcher = Inotify()
+		except (OSError, AttributeError, TypeError) as e:
+			print("inotify unavailable, polling:", e)
+			self.watcher = None
+
+	def record(self, source, target, status, reason=None):
+		entry = {"t":time.strftime("%Y-%m-%dT%H:%M:%S"), "source":source, "target":target, "status":status}
+		if reason:
+			entry["reason"] = reason
+		self.log.write(json.dumps(entry) + "\n")
+		self.log.flush()
+		if status != "moved" and source in self.pending:
+			self.handled[source] = self.pending[source][:2]
+			#the oldest are forgotten first, at worst they are logged once more
+			while len(self.handled) > self.limit:
+				del self.handled[next(iter(self.handled))]
+
+	def watch(self, folder):
+		if self.watcher is not None:
+			try:
+				self.watcher.add(folder)
+			except OSError as e:
+				print(e)
+
+	def scan(self, folder, now):
+		#streams the listing, stops taking files once pending is full
+		try:
+			entries = os.scandir(folder)
+		except OSError as e:
+			print(e)
+			return
+		with entries:
+			for entry in entries:
+				if entry.is_dir(follow_symlinks=False):
+					if self.isInside(entry.path):
+						self.watch(entry.path)
+						self.scan(entry.path, now)
+				elif entry.is_file():
+					self.touch(entry.path, now, False)
+
+	def isInside(self, path):
+		#the target tree may live inside an inbox, it is never ingested again
+		path = os.path.abspath(path)
+		return path != self.target and not path.startswith(self.target + os.sep)
+
+	def rescan(self):
+		self.overflow = False
+		self.listings = {}
+		now = time.time()
+		for inbox in self.inboxes:
+			self.watch(inbox)
+			self.scan(inbox, now)
+
+	def touch(self, path, now, event):
+		name = os.path.basename(path)
+		if not self.shots.kind(name) or name.startswith("."):
+			return
+		try:
+			st = os.stat(path)
+		except OSError:
+			self.forget(path)
+			return
+		if path in self.handled:
+			if self.handled[path] == (st.st_size, st.st_mtime):
+				return
+			del self.handled[path]
+		known = self.pending.get(path)
+		if known is None:
+			key = (os.path.dirname(path), self.shots.shotStem(name))
+			#a twin of a pending file is always taken, a shot is never split by the limit
+			if len(self.pending) >= self.limit and key not in self.groups:
+				self.overflow = True
+				return
+			#files found by a scan that were written long ago have settled already
+			last = now if event else min(now, st.st_mtime)
+			self.pending[path] = (st.st_size, st.st_mtime, last)
+			self.groups.setdefault(key, set()).add(path)
+		elif event or known[:2] != (st.st_size, st.st_mtime):
+			self.pending[path] = (st.st_size, st.st_mtime, now)
+
+	def forget(self, path):
+		if self.pending.pop(path, None) is not None:
+			key = (os.path.dirname(path), self.shots.shotStem(os.path.basename(path)))
+			paths = self.groups.get(key)
+			if paths is not None:
+				paths.discard(path)
+				if not paths:
+					del self.groups[key]
+
+	def isSettled(self, path, now):
+		size, mtime, last = self.pending[path]
+		if now - last < self.settle:
+			return False
+		try:
+			st = os.stat(path)
+		except OSError:
+			return True
+		if (st.st_size, st.st_mtime) != (size, mtime):
+			self.pending[path] = (st.st_size, st.st_mtime, now)
+			return False
+		return True
+
+	def process(self):
+		now = time.time()
+		for key in list(self.groups):
+			paths = self.groups[key]
+			if not all(self.isSettled(p, now) for p in paths):
+				continue
+			files = set(paths)
+			try:
+				if self.overflow:
+					#files left out while pending was full may belong to this shot
+					missed = self.missedFiles(key[0], key[1], now)
+					if missed is None:
+						continue
+					files.update(missed)
+				self.ingest(key[0], sorted(files))
+			except OSError as e:
+				#a file gone or unreadable only fails its own shot, the daemon goes on
+				for p in sorted(files):
+					self.record(p, None, "failed", str(e))
+			for p in list(paths):
+				self.forget(p)
+
+	def missedFiles(self, folder, stem, now):
+		#None while one of them is still being written
+		listing = self.listings.get(folder)
+		if listing is None or time.monotonic() - listing[0] > self.settle / 2:
+			index = {}
+			with os.scandir(folder) as entries:
+				for entry in entries:
+					if self.shots.kind(entry.name) and not entry.name.startswith("."):
+						index.setdefault(self.shots.shotStem(entry.name), []).append(entry.name)
+			listing = (time.monotonic(), index)
+			self.listings[folder] = listing
+			while len(self.listings) > 16:
+				del self.listings[next(iter(self.listings))]
+		missed = []
+		for name in listing[1].get(stem, []):
+			path = os.path.join(folder, name)
+			if path in self.pending or path in self.handled:
+				continue
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			if now - st.st_mtime < self.settle:
+				return None
+			missed.append(path)
+		return missed
+
+	def targetStems(self, folder):
+		stems = self.stems.pop(folder, None)
+		if stems is None:
+			stems = set()
+			if os.path.isdir(folder):
+				with os.scandir(folder) as entries:
+					for entry in entries:
+						stems.add(self.shots.shotStem(entry.name))
+		#most recently used last, only a few folders are kept
+		self.stems[folder] = stems
+		while len(self.stems) > 16:
+			del self.stems[next(iter(self.stems))]
+		return stems
+
+	def ingest(self, folder, paths):
+		names = [os.path.basename(p) for p in paths if os.path.exists(p)]
+		primaries = self.shots.build(names)
+		if not primaries:
+			for name in names:
+				self.record(os.path.join(folder, name), None, "skipped", "no photo for this sidecar")
+			return
+		primary = primaries[0]
+		source = os.path.join(folder, primary)
+		date = os.path.getmtime(source)
+		tags = state_tags(self.state, date)
+		if not tags:
+			for name in self.shots.files(primary):
+				self.record(os.path.join(folder, name), None, "skipped", "no tags checked")
+			return
+
+		dest = os.path.join(self.target, *date_tag(self.layout, date).split("/")) if self.layout else self.target
+		stems = self.targetStems(dest)
+		def isTaken(stem):
+			#same rule as in the viewer, a free name for every file, and no merge with another shot
+			if stem in stems:
+				return True
+			return any(os.path.exists(os.path.join(dest, t)) for n, t in self.shots.targets(primary, stem))
+		newstem = unique_stem(tags, isTaken)
+
+		pairs = [(os.path.join(folder, a), os.path.join(dest, b)) for a, b in self.shots.targets(primary, newstem)]
+		op = FileOperation("move", pairs[0][0], pairs[0][1], companions=pairs[1::])
+		try:
+			op.run()
+		except Exception as e:
+			for a, b in pairs:
+				self.record(a, b, "failed", str(e))
+			return
+		stems.add(newstem)
+		for a, b in pairs:
+			self.record(a, b, "moved")
+		print("%s in %s" % (op, dest))
+
+	def run(self, once=False):
+		self.rescan()
+		while self.running:
+			now = time.time()
+			if self.watcher is not None:
+				for path, mask in self.watcher.read(self.settle / 2):
+					if path is None:
+						self.overflow = True
+					elif mask & Inotify.IN_ISDIR:
+						if self.isInside(path):
+							self.watch(path)
+							self.scan(path, now)
+					else:
+						self.touch(path, now, True)
+			else:
+				time.sleep(self.settle / 2)
+				self.rescan()
+			self.process()
+			if self.overflow and len(self.pending) < self.limit // 2:
+				self.rescan()
+			if once and not self.pending and not self.overflow:
+				break
+
+	def stop(self, *args):
+		self.running = False
+
+	def close(self):
+		if self.watcher is not None:
+			self.watcher.close()
+		self.log.close()
+
+def ingest(args):
+	state = load_state(args.state)
+	if not state:
+		print("no tags state to name the photos with, rename some in the viewer first or give --state")
+		return
+	daemon = IngestDaemon(args.watch, args.target, state, args.layout, args.log, args.settle, args.limit)
+	signal.signal(signal.SIGTERM, daemon.stop)
+	try:
+		daemon.run(args.once)
+	except KeyboardInterrupt:
+		pass
+	finally:
+		daemon.close()
+
+def make_synthetic_folder(folder, count, size=(3000, 2000)):
+	#gradients compress and decode like real photos better than flat colors
+	base = Image.linear_gradient("L").resize(size)
+	start = calendar.timegm((2015, 3, 1, 12, 0, 0))
+	for i in range(count):
+		im = Image.merge("RGB", (base, base.transpose(Image.FLIP_LEFT_RIGHT), base.point(lambda x, i=i:(x+i*37) % 256)))
+		exif = im.getexif()
+		#bursts of five shots, a new event every fifty
+		t = start + (i // 50) * 86400 + (i % 50 // 5) * 600 + i % 5
+		exif.get_ifd(0x8769)[36867] = time.strftime("%Y:%m:%d %H:%M:%S", time.gmtime(t))
+		im.save(os.path.join(folder, "DSC_%05d.JPG" % i), quality=90, exif=exif)
+
+def percentile(values, p):
+	values = sorted(values)
+	if not values:
+		return 0.0
+	return values[min(len(values)-1, int(round(p/100.0 * (len(values)-1))))]
+
+class SessionReplayer(object):
+	#drives a MainWindow through a recorded session and measures each action
+	def __init__(self, window, realtime=False, timeout=30.0):
+		self.window = window
+		self.realtime = realtime
+		self.timeout = timeout
+		self.gui = {}
+		self.settled = {}
+		self.superseded = {}
+
+	def perform(self, entry):
+		w = self.window
+		action = entry["a"]
+		if action == "folder":
+			w.folderChange(w.folder)
+		elif action == "next":
+			w.imageDisplay.nextPhoto()
+		elif action == "previous":
+			w.imageDisplay.previousPhoto()
+		elif action == "rename":
+			#the recorded tags already include the places checked for the photo
+			w.flushAutoTag()
+			w.tagsManager.setCheckedNames(entry.get("tags", []))
+			w.rename()
+		elif action == "renameGroup":
+			w.flushAutoTag()
+			w.tagsManager.setCheckedNames(entry.get("tags", []))
+			w.groupLevelCombo.setCurrentIndex(max(0, w.groupLevelCombo.findData(entry.get("level", "burst"))))
+			w.renameGroup()
+		elif action == "rotate":
+			w.rotateImg(entry.get("direction", 1))
+		elif action == "delete":
+			w.deleteCurrent()
+		elif action == "resize":
+			w.resize(*entry["size"])
+		elif action == "split":
+			w.splitter.setSizes(entry["sizes"])
+		elif action == "filter":
+			w.filterChange(entry.get("text", ""), entry.get("untagged", False))
+
+	def waitUntil(self, condition, deadline):
+		app = QApplication.instance()
+		while True:
+			app.processEvents()
+			if condition():
+				return True
+			if time.perf_counter() >= deadline:
+				return False
+			time.sleep(0.001)
+
+	def run(self, entries):
+		start = time.perf_counter()
+		#recording itself is disabled while replaying
+		self.window.recorder = None
+		self.waitUntil(self.window.isSettled, start + self.timeout)
+		start = time.perf_counter()
+		for i, entry in enumerate(entries):
+			if self.realtime:
+				self.waitUntil(lambda:False, start + entry["t"])
+
+			t0 = time.perf_counter()
+			self.perform(entry)
+			t1 = time.perf_counter()
+
+			#in realtime, the next action may come before this one is done, as it did for the user
+			deadline = t1 + self.timeout
+			if self.realtime and i+1 < len(entries):
+				deadline = min(deadline, start + entries[i+1]["t"])
+			done = self.waitUntil(self.window.isSettled, deadline)
+
+			action = entry["a"]
+			self.gui.setdefault(action, []).append((t1 - t0) * 1000)
+			if done:
+				self.settled.setdefault(action, []).append((time.perf_counter() - t0) * 1000)
+			else:
+				self.superseded[action] = self.superseded.get(action, 0) + 1
+
+	def report(self):
+		lines = ["%-12s %6s %9s %9s %9s %9s %9s %9s %6s" % ("action", "count", "gui p50", "gui p90", "gui max",
+					"done p50", "done p90", "done p99", "skip")]
+		for action in sorted(self.gui):
+			gui = self.gui[action]
+			settled = self.settled.get(action, [])
+			lines.append("%-12s %6d %9.1f %9.1f %9.1f %9.1f %9.1f %9.1f %6d" % (action, len(gui),
+					percentile(gui, 50), percentile(gui, 90), max(gui),
+					percentile(settled, 50), percentile(settled, 90), percentile(settled, 99),
+					self.superseded.get(action, 0)))
+		return "\n".join(lines)
+
+	def results(self):
+		output = {"actions":{}, "memory":memoryBudget.stats, "metadata":metadataCache.stats}
+		for action in self.gui:
+			output["actions"][action] = {"gui":self.gui[action], "settled":self.settled.get(action, []),
+										"superseded":self.superseded.get(action, 0)}
+		return output
+
+def replay(args):
+	os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+	app = QApplication.instance() or QApplication(sys.argv)
+	with open(args.replay, "r", encoding="utf-8") as f:
+		entries = [json.loads(line) for line in f if line.strip()]
+	states = [e["state"] for e in entries if e["a"] == "state"]
+	entries = [e for e in entries if e["a"] != "state"]
+	if args.state:
+		state = load_state(args.state)
+	elif states:
+		state = states[0]
+	else:
+		print("the session has no tags state, replaying with the current config")
+		state = None
+
+	#the session renames, rotates and deletes files, never replay it on the originals
+	workdir = tempfile.mkdtemp(prefix="photorenamer_replay_")
+	folder = os.path.join(workdir, "photos")
+	try:
+		if args.against:
+			shutil.copytree(args.against, folder)
+		else:
+			os.makedirs(folder)
+			width, height = [int(x) for x in args.size.lower().split("x")]
+			make_synthetic_folder(folder, args.synthetic, (width, height))
+
+		window = MainWindow(folder, state=state)
+		window.operations.trash = os.remove
+		window.show()
+		replayer = SessionReplayer(window, args.realtime)
+		replayer.run(entries)
+		print(replayer.report())
+		if args.output:
+			with open(args.output, "w") as f:
+				json.dump(replayer.results(), f, indent=4)
+
+		window.imageDisplay.loader.stop()
+		window.operations.shutdown()
+		#results still queued for the gui would be handled after the folder is gone
+		app.processEvents()
+	finally:
+		shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+	parser = argparse.ArgumentParser(description="Photos renamer")
+	parser.add_argument("folder", nargs="?", default="C:")
+	parser.add_argument("--record", metavar="FILE", help="record the session's actions to FILE")
+	parser.add_argument("--replay", metavar="FILE", help="replay a recorded session headless and report latencies")
+	parser.add_argument("--against", metavar="DIR", help="replay against a copy of DIR instead of generated photos")
+	parser.add_argument("--synthetic", type=int, default=200, help="number of generated photos to replay against")
+	parser.add_argument("--size", default="3000x2000", help="size of the generated photos")
+	parser.add_argument("--realtime", action="store_true", help="replay with the recorded pacing")
+	parser.add_argument("--output", metavar="FILE", help="write the replay measurements as json")
+	parser.add_argument("--watch", metavar="DIR", nargs="+", help="run headless, ingest the photos copied into the DIR folders")
+	parser.add_argument("--target", metavar="DIR", help="folder the ingested photos are moved to")
+	parser.add_argument("--layout", default="YYYY/MM", help="date template of the target subfolders, empty for none")
+	parser.add_argument("--state", metavar="FILE", help="tags state to name with in --watch or --replay, defaults to the viewer's config or the recorded one")
+	parser.add_argument("--log", metavar="FILE", help="per file log, defaults to photorenamer_ingest.jsonl in the target")
+	parser.add_argument("--settle", type=float, default=2.0, help="seconds a file must stay unchanged before it is moved")
+	parser.add_argument("--limit", type=int, default=5000, help="most files tracked at once")
+	parser.add_argument("--once", action="store_true", help="ingest what the inboxes hold and exit")
+	args = parser.parse_args()
+
+	if args.replay:
+		replay(args)
+		return
+	if args.watch:
+		if not args.target:
+			parser.error("--watch needs --target")
+		os.makedirs(args.target, exist_ok=True)
+		ingest(args)
+		return
+
+	app = QApplication(sys.argv)
+	recorder = SessionRecorder(args.record) if args.record else None
+	window = MainWindow(args.folder, recorder)
+	# window = MainWindow("D:\\__Personnel\\Photos\\1ere annee au canada 2015 hiver printemps\\")
+	window.show()
+	app.exec()
+
 # Logo = resource_path("Logo.png")
-app = QApplication(sys.argv)
-window = MainWindow("C:")
-# window = MainWindow("D:\\__Personnel\\Photos\\1ere annee au canada 2015 hiver printemps\\")
-window.show()
-app.exec()
+#decoding processes import this module again, the window must only be created once
+if __name__ == "__main__":
+	multiprocessing.freeze_support()
+	main()